@@ -0,0 +1,177 @@
+"""
+Compares the proxy's throughput on the asyncio and uvloop event loops,
+on the streaming chat completions path.
+
+Usage:
+    pip install uvloop
+    python dev_scripts/bench_event_loop.py [--requests N] [--concurrency C]
+                                           [--chunks K] [--loops asyncio uvloop]
+
+A fake Argo upstream streaming K chunks per request runs in its own
+process, the proxy runs in another one for each loop, and the load is
+generated from this process. The report shows requests per second, and
+the median and p99 of the time to the first chunk and of the whole stream.
+"""
+
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+UPSTREAM_PORT = 47101
+PROXY_PORT = 47102
+
+
+def run_upstream(port, chunks):
+    async def stream_chat(request):
+        await request.read()
+        response = web.StreamResponse(headers={"Content-Type": "text/plain"})
+        await response.prepare(request)
+        for index in range(chunks):
+            await response.write(f"token{index} ".encode())
+            await asyncio.sleep(0)
+        await response.write_eof()
+        return response
+
+    async def chat(request):
+        await request.read()
+        return web.json_response({"response": "ok"})
+
+    upstream = web.Application()
+    upstream.router.add_post("/chat/", chat)
+    upstream.router.add_post("/streamchat/", stream_chat)
+    upstream.router.add_post("/embed/", chat)
+    upstream.router.add_get("/health", lambda request: web.Response(text="ok"))
+    web.run_app(upstream, port=port, print=None, access_log=None)
+
+
+def run_proxy(port, upstream_port, loop):
+    from argoproxy.app import run
+    from argoproxy.config import ArgoConfig
+
+    base = f"http://127.0.0.1:{upstream_port}"
+    run(
+        ArgoConfig(
+            host="127.0.0.1",
+            port=port,
+            user="bench",
+            argo_url=f"{base}/chat/",
+            argo_stream_url=f"{base}/streamchat/",
+            argo_embedding_url=f"{base}/embed/",
+            verbose=False,
+            usage_mode="estimate",
+            stream_replay_ttl=0,
+            server={"loop": loop},
+        )
+    )
+
+
+def spawn(*args):
+    return subprocess.Popen(
+        [sys.executable, __file__, *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(url, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+async def load(url, requests, concurrency):
+    body = {
+        "model": "argo:gpt-4o",
+        "messages": [{"role": "user", "content": "Hello"}],
+        "stream": True,
+    }
+    first_chunk, total = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(url, json=body) as resp:
+                    resp.raise_for_status()
+                    first = None
+                    async for _ in resp.content.iter_any():
+                        if first is None:
+                            first = time.perf_counter() - start
+                first_chunk.append(first)
+                total.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+    return requests / elapsed, first_chunk, total
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))] * 1000
+
+
+async def bench(loop, args):
+    proxy = spawn("--proxy", loop)
+    try:
+        await wait_ready(f"http://127.0.0.1:{PROXY_PORT}/health")
+        url = f"http://127.0.0.1:{PROXY_PORT}/v1/chat/completions"
+        await load(url, args.concurrency, args.concurrency)  # warm-up
+        rate, first_chunk, total = await load(url, args.requests, args.concurrency)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+    print(
+        f"{loop:<8}{rate:>10.0f}"
+        f"{statistics.median(first_chunk) * 1000:>10.1f}{percentile(first_chunk, 0.99):>10.1f}"
+        f"{statistics.median(total) * 1000:>10.1f}{percentile(total, 0.99):>10.1f}"
+    )
+
+
+async def main(args):
+    upstream = spawn("--upstream", str(args.chunks))
+    try:
+        await wait_ready(f"http://127.0.0.1:{UPSTREAM_PORT}/health")
+        print(
+            f"{args.requests} streams of {args.chunks} chunks, "
+            f"{args.concurrency} concurrent"
+        )
+        print(
+            f"{'loop':<8}{'req/s':>10}{'ttfc p50':>10}{'p99':>10}{'total p50':>10}{'p99':>10}"
+        )
+        for loop in args.loops:
+            await bench(loop, args)
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--upstream"]:
+        run_upstream(UPSTREAM_PORT, int(sys.argv[2]))
+    elif sys.argv[1:2] == ["--proxy"]:
+        run_proxy(PROXY_PORT, UPSTREAM_PORT, sys.argv[2])
+    else:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, default=100)
+        parser.add_argument("--chunks", type=int, default=50)
+        parser.add_argument("--loops", nargs="+", default=["asyncio", "uvloop"])
+        asyncio.run(main(parser.parse_args()))
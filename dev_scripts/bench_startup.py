@@ -0,0 +1,134 @@
+"""
+Measures how long `argo-proxy` takes from launch until it serves /health,
+with the upstream URLs checked before starting (the default) and with
+`--fast-start`, which checks them in the background once serving.
+
+Usage:
+    python dev_scripts/bench_startup.py [--runs N] [--delay SECONDS]
+
+A fake Argo upstream answering after `--delay` seconds runs in its own
+process, standing in for a slow or distant API. The PyPI version check is
+cached on disk for a day, so only the first launch of a day waits for it;
+`--cold` clears the cache before each launch to measure that case.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import yaml
+
+UPSTREAM_PORT = 47111
+PROXY_PORT = 47112
+
+
+def run_upstream(port, delay):
+    import asyncio
+
+    from aiohttp import web
+
+    async def answer(request):
+        await request.read()
+        await asyncio.sleep(delay)
+        return web.json_response({"response": "ok"})
+
+    upstream = web.Application()
+    upstream.router.add_post("/chat/", answer)
+    upstream.router.add_post("/embed/", answer)
+    upstream.router.add_get("/health", lambda request: web.Response(text="ok"))
+    web.run_app(upstream, port=port, print=None, access_log=None)
+
+
+def wait_ready(url, process=None, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"process exited with {process.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.01)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def launch(config_path, flags, cold):
+    if cold:
+        from argoproxy.version import VERSION_CACHE_PATH
+
+        if os.path.exists(VERSION_CACHE_PATH):
+            os.remove(VERSION_CACHE_PATH)
+    start = time.perf_counter()
+    proxy = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from argoproxy.cli import main; main()",
+            config_path,
+            *flags,
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(f"http://127.0.0.1:{PROXY_PORT}/health", proxy)
+        return time.perf_counter() - start
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+def main(args):
+    upstream = subprocess.Popen(
+        [sys.executable, __file__, "--upstream", str(args.delay)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{UPSTREAM_PORT}"
+    config = {
+        "host": "127.0.0.1",
+        "port": PROXY_PORT,
+        "user": "bench",
+        "argo_url": f"{base}/chat/",
+        "argo_stream_url": f"{base}/chat/",
+        "argo_embedding_url": f"{base}/embed/",
+        "verbose": False,
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump(config, f)
+    try:
+        wait_ready(f"{base}/health")
+        print(
+            f"{args.runs} launches, upstream answering in {args.delay:g}s, "
+            f"version cache {'cleared' if args.cold else 'kept'}"
+        )
+        print(f"{'mode':<14}{'p50 s':>10}{'min s':>10}{'max s':>10}")
+        for mode, flags in (("default", []), ("--fast-start", ["--fast-start"])):
+            times = [launch(f.name, flags, args.cold) for _ in range(args.runs)]
+            print(
+                f"{mode:<14}{statistics.median(times):>10.2f}"
+                f"{min(times):>10.2f}{max(times):>10.2f}"
+            )
+    finally:
+        os.remove(f.name)
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--upstream"]:
+        run_upstream(UPSTREAM_PORT, float(sys.argv[2]))
+    else:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--runs", type=int, default=5)
+        parser.add_argument("--delay", type=float, default=1.0)
+        parser.add_argument("--cold", action="store_true")
+        main(parser.parse_args())
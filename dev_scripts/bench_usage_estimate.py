@@ -0,0 +1,163 @@
+"""
+Accuracy report and benchmark of the `estimate` usage mode against tiktoken.
+
+Usage:
+    python dev_scripts/bench_usage_estimate.py [--rounds N]
+
+The corpus is this repository's own documentation, source code and config
+files split into message-sized pieces, plus a few samples of non-Latin
+scripts. For each encoding the report shows the relative error of
+`estimate_tokens` per category, the rates fitted on the whole corpus that
+would suit TOKEN_ESTIMATE_RATES, and the time per message of the
+exact (cold and cached) and estimated counts.
+
+Exits with status 1 if a category's mean error exceeds ERROR_BOUNDS, the
+bounds documented in the README.
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import sys
+import time
+
+import tiktoken
+
+from argoproxy.utils import (
+    TOKEN_ESTIMATE_RATES,
+    count_tokens,
+    estimate_tokens,
+    token_count_cache,
+)
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+# Mean absolute relative error allowed per category
+ERROR_BOUNDS = {"prose": 0.15, "code": 0.25, "config": 0.25, "other scripts": 0.35}
+
+# Encoding -> a model using it
+MODELS = {"o200k_base": "argo:gpt-4o", "cl100k_base": "argo:gpt-4"}
+
+OTHER_SCRIPTS = [
+    "Прокси-сервер принимает запросы в формате OpenAI и пересылает их в Argo API.",
+    "Der Proxy übersetzt Anfragen im OpenAI-Format für die Argo-Schnittstelle.",
+    "代理服务器接收 OpenAI 格式的请求，并将其转发到 Argo 接口，然后把响应转换回来。",
+    "このプロキシは OpenAI 形式のリクエストを受け取り、Argo API に転送します。",
+    "프록시 서버는 OpenAI 형식의 요청을 받아 Argo API로 전달합니다.",
+    "Ο διακομιστής μεσολάβησης προωθεί αιτήματα μορφής OpenAI στο Argo API.",
+    "يقوم الخادم الوكيل بتحويل الطلبات بتنسيق OpenAI إلى واجهة Argo البرمجية.",
+    "प्रॉक्सी सर्वर OpenAI प्रारूप के अनुरोधों को Argo API तक पहुँचाता है।",
+]
+
+
+def split_messages(text, max_chars=2000):
+    """Split a document on blank lines into pieces of up to `max_chars`."""
+    pieces, current = [], ""
+    for block in text.split("\n\n"):
+        if current and len(current) + len(block) > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n\n{block}" if current else block
+    if current.strip():
+        pieces.append(current)
+    return pieces
+
+
+def load_corpus():
+    patterns = {
+        "prose": ["*.md"],
+        "code": ["src/argoproxy/**/*.py", "examples/**/*.py"],
+        "config": ["*.yaml", "*.toml"],
+    }
+    corpus = {}
+    for category, globs in patterns.items():
+        texts = []
+        for pattern in globs:
+            for path in sorted(glob.glob(os.path.join(ROOT, pattern), recursive=True)):
+                with open(path, encoding="utf-8") as f:
+                    texts.extend(split_messages(f.read()))
+        corpus[category] = texts
+    corpus["other scripts"] = OTHER_SCRIPTS * 4
+    return corpus
+
+
+def fit_rates(encoding, texts):
+    """Rates for ASCII characters and extra non-ASCII bytes fitted on totals."""
+    ascii_chars = ascii_tokens = extra_bytes = extra_tokens = 0
+    for text in texts:
+        tokens = len(encoding.encode(text))
+        if text.isascii():
+            ascii_chars += len(text)
+            ascii_tokens += tokens
+    chars_per_token = ascii_chars / ascii_tokens if ascii_tokens else 0.0
+    for text in texts:
+        if text.isascii():
+            continue
+        extra = len(text.encode("utf-8")) - len(text)
+        tokens = len(encoding.encode(text))
+        extra_bytes += extra
+        extra_tokens += tokens - max(len(text) - extra, 0) / chars_per_token
+    return chars_per_token, extra_tokens / extra_bytes if extra_bytes else 0.0
+
+
+def timed(fn, texts, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            fn(text)
+    return (time.perf_counter() - start) / (rounds * len(texts)) * 1e6
+
+
+def report(encoding_name, corpus, rounds):
+    model = MODELS[encoding_name]
+    encoding = tiktoken.get_encoding(encoding_name)
+    print(
+        f"\n== {encoding_name} ({model}), rates {TOKEN_ESTIMATE_RATES[encoding_name]}"
+    )
+    print(f"{'category':<14}{'texts':>6}{'mean':>8}{'p95':>8}{'max':>8}{'bias':>8}")
+
+    within_bounds = True
+    for category, texts in corpus.items():
+        errors = []
+        for text in texts:
+            exact = len(encoding.encode(text))
+            errors.append((estimate_tokens(text, model) - exact) / exact)
+        absolute = sorted(abs(e) for e in errors)
+        mean = statistics.mean(absolute)
+        p95 = absolute[int(0.95 * (len(absolute) - 1))]
+        print(
+            f"{category:<14}{len(texts):>6}{mean:>8.1%}{p95:>8.1%}"
+            f"{absolute[-1]:>8.1%}{statistics.mean(errors):>+8.1%}"
+        )
+        if mean > ERROR_BOUNDS[category]:
+            print(f"  mean error above the {ERROR_BOUNDS[category]:.0%} bound")
+            within_bounds = False
+
+    texts = [text for texts in corpus.values() for text in texts]
+    chars_per_token, tokens_per_extra_byte = fit_rates(encoding, texts)
+    print(f"fitted rates: ({chars_per_token:.2f}, {tokens_per_extra_byte:.2f})")
+
+    def exact_cold(text):
+        token_count_cache.clear()
+        return count_tokens(text, model)
+
+    print(f"time per message over {len(texts)} texts:")
+    print(f"  exact, uncached  {timed(exact_cold, texts, rounds):8.1f} us")
+    print(
+        f"  exact, cached    {timed(lambda t: count_tokens(t, model), texts, rounds):8.1f} us"
+    )
+    print(
+        f"  estimate         {timed(lambda t: estimate_tokens(t, model), texts, rounds):8.1f} us"
+    )
+    return within_bounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    results = [report(name, corpus, args.rounds) for name in MODELS]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,59 @@
+"""
+Checks that the CLI commands which do not serve import only what they need,
+using `python -X importtime`.
+
+Usage:
+    python dev_scripts/test_import_time.py
+
+Importing `argoproxy.cli` must not load aiohttp, pydantic, the endpoint
+modules or the response types, which only the server needs, and must take
+less than IMPORT_BUDGET_MS. The best of a few runs is kept, as the first
+one also pays for reading the bytecode from a cold disk cache.
+"""
+
+import re
+import subprocess
+import sys
+
+IMPORT_BUDGET_MS = 150
+RUNS = 5
+# Modules that only the server needs
+SERVER_ONLY = ("aiohttp", "pydantic", "argoproxy.endpoints", "argoproxy.types")
+
+
+def import_times(module):
+    """Cumulative import time in ms of each module imported by `module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            times[match.group(3)] = int(match.group(1)) / 1000
+    return times
+
+
+def test_cli_skips_server_modules():
+    loaded = import_times("argoproxy.cli")
+    heavy = sorted(
+        name
+        for name in loaded
+        if any(name == top or name.startswith(f"{top}.") for top in SERVER_ONLY)
+    )
+    assert not heavy, f"argoproxy.cli imports server modules: {', '.join(heavy)}"
+
+
+def test_cli_import_budget():
+    best = min(import_times("argoproxy.cli")["argoproxy.cli"] for _ in range(RUNS))
+    print(f"argoproxy.cli imports in {best:.0f} ms (budget {IMPORT_BUDGET_MS} ms)")
+    assert best < IMPORT_BUDGET_MS, f"{best:.0f} ms > {IMPORT_BUDGET_MS} ms"
+
+
+if __name__ == "__main__":
+    test_cli_skips_server_modules()
+    test_cli_import_budget()
+    print("All import time checks passed")
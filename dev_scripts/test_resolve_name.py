@@ -1,10 +1,9 @@
 import os
 
-from argoproxy.constants import CHAT_MODELS
 from argoproxy.utils import resolve_model_name
 
 MODEL = os.getenv("MODEL", "argo:gpt-4o")
-DEFAULT_MODEL = "argo:gpt-4o"
+DEFAULT_MODEL = "gpt4o"
 
-resolved_name = resolve_model_name(MODEL, DEFAULT_MODEL, avail_models=CHAT_MODELS)
+resolved_name = resolve_model_name(MODEL, DEFAULT_MODEL, kind="chat")
 print(resolved_name)
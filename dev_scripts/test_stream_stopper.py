@@ -0,0 +1,81 @@
+"""
+Checks the proxy-side enforcement of stop sequences, max_tokens and the
+token rate limit bucket.
+
+Usage:
+    python dev_scripts/test_stream_stopper.py
+
+Needs the o200k_base encoding, from the network or a bundle configured
+with TIKTOKEN_CACHE_DIR (see `argo-proxy --bundle-tiktoken`).
+"""
+
+from argoproxy.ratelimit import TokenBucket
+from argoproxy.utils import StreamStopper
+
+MODEL = "argo:gpt-4o"
+
+
+def stream(stopper, chunks):
+    """Feeds `chunks` like the chat stream loop and returns the sent text."""
+    sent = []
+    for chunk in chunks:
+        sent.append(stopper.feed(chunk))
+        if stopper.finish_reason:
+            break
+    else:
+        sent.append(stopper.flush())
+    return "".join(sent)
+
+
+def test_stop_split_across_chunks():
+    stopper = StreamStopper(MODEL, stop=["\nEND"])
+    text = stream(stopper, ["Hello world\n", "E", "ND and more"])
+    assert text == "Hello world", repr(text)
+    assert stopper.finish_reason == "stop"
+
+    # A held-back prefix that turns out not to be a stop is sent later
+    stopper = StreamStopper(MODEL, stop=["\nEND"])
+    text = stream(stopper, ["Hello\n", "EN", "TRY"])
+    assert text == "Hello\nENTRY", repr(text)
+    assert stopper.finish_reason is None
+
+
+def test_max_tokens_cut():
+    stopper = StreamStopper(MODEL, max_tokens=3)
+    text = stream(stopper, ["one two", " three four", " five"])
+    assert stopper.finish_reason == "length"
+    assert stopper.completion_tokens == 3
+    assert text == "one two three", repr(text)
+
+    # The budget also applies to text released by flush
+    stopper = StreamStopper(MODEL, stop=["###"], max_tokens=2)
+    text = stream(stopper, ["alpha beta gamma #"])
+    assert stopper.finish_reason == "length"
+    assert len(stopper.encoding.encode(text)) == 2, repr(text)
+
+
+def test_usage_estimate_without_encoder():
+    stopper = StreamStopper(MODEL, count_usage=True, usage_mode="estimate")
+    assert stopper.encoding is None
+    stream(stopper, ["a" * 40] * 10)
+    assert stopper.completion_tokens > 0
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(capacity=60, rate=1, now=0.0)
+    bucket.take(50, now=0.0)
+    # Completion tokens charged after admission push the bucket into debt
+    bucket.take(40, now=0.0)
+    assert bucket.level(0.0) == -30
+    assert bucket.wait_time(1, now=0.0) == 31
+    assert bucket.wait_time(1, now=31.0) == 0
+    # The level never refills beyond the capacity
+    assert bucket.level(1000.0) == 60
+    assert bucket.reset_time(1000.0) == 0
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")
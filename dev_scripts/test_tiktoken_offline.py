@@ -0,0 +1,70 @@
+"""
+Checks that the tokenizer warm-up works without network access.
+
+Usage:
+    argo-proxy --bundle-tiktoken /tmp/tiktoken_bundle   # on a machine with internet
+    python dev_scripts/test_tiktoken_offline.py /tmp/tiktoken_bundle
+
+All sockets are disabled before tiktoken is touched, so any attempt to
+download an encoding fails immediately instead of hanging.
+"""
+
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+
+
+def block_network():
+    def refuse(*args, **kwargs):
+        raise OSError("network access disabled by test_tiktoken_offline")
+
+    socket.socket.connect = refuse
+    socket.socket.connect_ex = refuse
+    socket.getaddrinfo = refuse
+    socket.create_connection = refuse
+
+
+async def check_bundle(cache_dir):
+    from argoproxy.utils import (
+        WARMUP_ENCODINGS,
+        configure_tiktoken_cache,
+        count_tokens,
+        warm_up_tokenizers_async,
+    )
+
+    assert configure_tiktoken_cache(cache_dir) == cache_dir
+    start = time.perf_counter()
+    failed = await warm_up_tokenizers_async()
+    elapsed = time.perf_counter() - start
+    assert not failed, f"encodings not loaded from {cache_dir}: {failed}"
+    print(f"warmed {', '.join(WARMUP_ENCODINGS)} offline in {elapsed:.2f}s")
+
+    for model in ("argo:gpt-4o", "argo:gpt-4"):
+        tokens = count_tokens("Hello from an air-gapped node!", model)
+        assert tokens > 0
+        print(f"{model}: {tokens} tokens")
+
+
+async def check_missing_bundle():
+    from argoproxy.utils import configure_tiktoken_cache, warm_up_tokenizers_async
+
+    with tempfile.TemporaryDirectory() as empty_dir:
+        configure_tiktoken_cache(empty_dir)
+        start = time.perf_counter()
+        failed = await warm_up_tokenizers_async(timeout=10)
+        elapsed = time.perf_counter() - start
+    assert failed, "warm-up succeeded without encoding files or network"
+    print(f"missing bundle reported in {elapsed:.2f}s: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    block_network()
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else os.getenv("TIKTOKEN_BUNDLE")
+    if cache_dir:
+        asyncio.run(check_bundle(os.path.abspath(cache_dir)))
+    else:
+        asyncio.run(check_missing_bundle())
+    print("OK")
@@ -1,31 +1,155 @@
+import asyncio
 import os
+import signal
 import sys
+from http import HTTPStatus
+from typing import Optional, Set
 
+import aiohttp
 from aiohttp import web
 from loguru import logger
 
 from .__init__ import __version__
-from .config import load_config
-from .endpoints import chat, completions, embed, extras, responses
-from .endpoints.extras import get_latest_pypi_version
+from .config import ArgoConfig, ServerConfig, load_config
+from .metrics import CONTENT_TYPE, ProxyMetrics, metrics_middleware
+from .models import (
+    build_registry,
+    get_registry,
+    load_cached_catalog,
+    read_catalog,
+    save_cached_catalog,
+    set_registry,
+)
+from .ratelimit import RateLimiter, rate_limit_middleware
+from .runtime import Runtime, Upstream, reload_config, snapshot_middleware
+from .server import run_server
+from .streaming import StreamRegistry
+from .utils import configure_tiktoken_cache, warm_up_tokenizers_async
+from .version import check_version, get_latest_pypi_version
 
 
 async def setup_config(app):
     """Load configuration without validation for worker processes"""
-    config_path = os.getenv("CONFIG_PATH")
-    app["config"], _ = load_config(config_path)
+    runtime: Runtime = app["runtime"]
+    if runtime.config is None:  # otherwise given to create_app
+        runtime.config, _ = load_config(os.getenv("CONFIG_PATH"))
+
+
+async def setup_tokenizers(app):
+    """Load the tiktoken encodings before the server starts accepting requests.
+
+    Otherwise the first request on each worker stalls while tiktoken downloads
+    and parses its BPE files.
+    """
+    cache_dir = configure_tiktoken_cache(app["runtime"].config.tiktoken_cache_dir)
+    if cache_dir:
+        logger.info(f"Loading tiktoken encodings from {cache_dir}")
+    failed = await warm_up_tokenizers_async()
+    if failed:
+        logger.warning(
+            f"tiktoken encodings {', '.join(failed)} are not available; set "
+            "`tiktoken_cache_dir` to a directory created with "
+            "`argo-proxy --bundle-tiktoken <dir>`"
+        )
+
 
+async def setup_session(app):
+    """Create the upstream client session shared by all handlers.
+
+    Streams outlive the handler that started them, so the session cannot be
+    scoped to a single request.
+    """
+    app["runtime"].upstream = Upstream()
+
+
+async def cleanup_session(app):
+    await app["runtime"].close()
+
+
+async def setup_model_catalog(app):
+    """
+    Use the model catalog cached by the last run, if any, and keep reading
+    it in the background. Startup does not wait for the catalog source.
+    """
+    source = app["runtime"].config.model_catalog
+    if source and (catalog := load_cached_catalog(source)):
+        try:
+            set_registry(build_registry(catalog))
+        except ValueError as err:
+            logger.warning(f"Ignoring the cached model catalog: {err}")
+    app["catalog_refresher"] = asyncio.create_task(refresh_model_catalog(app))
+
+
+async def cleanup_model_catalog(app):
+    app["catalog_refresher"].cancel()
+    await asyncio.gather(app["catalog_refresher"], return_exceptions=True)
+
+
+async def refresh_model_catalog(app):
+    """
+    Reads `model_catalog` every `model_catalog_refresh` seconds and swaps in
+    a registry of the built-in models merged with it. A failed read keeps
+    the current registry. The config is read anew each time, so reloads
+    apply to the next read.
+    """
+    while True:
+        config = app["runtime"].config
+        source = config.model_catalog
+        try:
+            catalog = await read_catalog(source) if source else None
+            registry = build_registry(catalog)
+        except Exception as err:
+            logger.warning(f"Could not read the model catalog {source}: {err}")
+        else:
+            if registry.etag != get_registry().etag:
+                logger.info(f"Model catalog updated: {len(registry.aliases())} models")
+            set_registry(registry)
+            if catalog is not None:
+                await asyncio.to_thread(save_cached_catalog, source, catalog)
+        if not config.model_catalog_refresh:
+            return
+        await asyncio.sleep(config.model_catalog_refresh)
+
+
+async def setup_streams(app):
+    """Create the registry of resumable and coalesced streams"""
+    config = app["runtime"].config
+    app["streams"] = StreamRegistry(
+        config.stream_replay_ttl,
+        coalescing=config.stream_coalescing,
+        grace=config.stream_resume_grace,
+    )
+
+
+async def cleanup_streams(app):
+    app["streams"].close()
+
+
+async def setup_ratelimiter(app):
+    """Create the per-client request and token rate limiter"""
+    config = app["runtime"].config
+    app["ratelimiter"] = RateLimiter(
+        config.rate_limit_rpm, config.rate_limit_tpm, key=config.rate_limit_key
+    )
+
+
+# The endpoint modules, and the pydantic types they use, are imported by
+# the handlers so they load on first use rather than with the CLI
 
 # ================= Argo Direct Access =================
 
 
 async def proxy_argo_chat_directly(request: web.Request):
     logger.info("/v1/chat")
+    from .endpoints import chat
+
     return await chat.proxy_request(request, convert_to_openai=False)
 
 
 async def proxy_embedding_directly(request: web.Request):
     logger.info("/v1/embed")
+    from .endpoints import embed
+
     return await embed.proxy_request(request, convert_to_openai=True)
 
 
@@ -34,27 +158,44 @@ async def proxy_embedding_directly(request: web.Request):
 
 async def proxy_openai_chat_compatible(request: web.Request):
     logger.info("/v1/chat/completions")
+    from .endpoints import chat
+
     return await chat.proxy_request(request)
 
 
 async def proxy_openai_legacy_completions_compatible(request: web.Request):
     logger.info("/v1/completions")
+    from .endpoints import completions
+
     return await completions.proxy_request(request)
 
 
 async def proxy_openai_responses_request(request: web.Request):
     logger.info("/v1/responses")
+    from .endpoints import responses
+
     return await responses.proxy_request(request)
 
 
 async def proxy_openai_embedding_request(request: web.Request):
     logger.info("/v1/embeddings")
+    from .endpoints import embed
+
     return await embed.proxy_request(request, convert_to_openai=True)
 
 
+async def resume_stream(request: web.Request):
+    logger.info("/v1/streams")
+    from .endpoints import streams
+
+    return await streams.resume_request(request)
+
+
 async def get_models(request: web.Request):
     logger.info("/v1/models")
-    return extras.get_models()
+    from .endpoints import extras
+
+    return extras.get_models(request)
 
 
 async def docs(request: web.Request):
@@ -64,12 +205,72 @@ async def docs(request: web.Request):
 
 async def health_check(request: web.Request):
     logger.info("/health")
+    if request.app["runtime"].draining:
+        return web.json_response(
+            {"status": "draining", "streams": request.app["streams"].active},
+            status=HTTPStatus.SERVICE_UNAVAILABLE,
+        )
     return web.json_response({"status": "healthy"}, status=200)
 
 
+async def get_metrics(request: web.Request):
+    return web.Response(
+        body=request.app["metrics"].render(), headers={"Content-Type": CONTENT_TYPE}
+    )
+
+
+async def admin_reload(request: web.Request):
+    logger.info("/admin/reload")
+    token = request["config"].admin_token
+    if not token or request.headers.get("Authorization") != f"Bearer {token}":
+        return web.json_response(
+            {"error": "Unauthorized"}, status=HTTPStatus.UNAUTHORIZED
+        )
+
+    if supervisor := request.app.get("supervisor"):
+        # Every worker reloads, not only the one handling this request
+        os.kill(supervisor, signal.SIGHUP)
+        return web.json_response({"status": "reloading"}, status=HTTPStatus.ACCEPTED)
+    try:
+        changed = await reload_config(request.app)
+    except (ValueError, TypeError) as err:  # an invalid file, the config is kept
+        return web.json_response({"error": str(err)}, status=HTTPStatus.BAD_REQUEST)
+    return web.json_response({"status": "reloaded", "changed": changed})
+
+
+def background_checks(check_urls: bool = False):
+    """
+    Returns a startup hook checking for a newer version, and the upstream
+    URLs if `check_urls`, in the background while the server starts
+    serving. Problems are only logged.
+    """
+    tasks: Set["asyncio.Task[None]"] = set()
+
+    async def check(config: ArgoConfig) -> None:
+        checks = [check_version()]
+        if check_urls:
+            checks.append(check_upstream(config))
+        await asyncio.gather(*checks)
+
+    async def check_upstream(config: ArgoConfig) -> None:
+        for error in await config.check_urls():
+            logger.error(f"URL validation error: {error}")
+
+    async def start(app: web.Application) -> None:
+        task = asyncio.create_task(check(app["runtime"].config))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def stop(app: web.Application) -> None:
+        for task in tasks:
+            task.cancel()
+
+    return start, stop
+
+
 async def get_version(request: web.Request):
     logger.info("/version")
-    latest = await get_latest_pypi_version()
+    latest = await get_latest_pypi_version(max_age=0)
     update_available = latest and latest != __version__
 
     response = {
@@ -92,25 +293,79 @@ async def get_version(request: web.Request):
     return web.json_response(response)
 
 
-app = web.Application()
-app.on_startup.append(setup_config)
-
-# openai incompatible
-app.router.add_post("/v1/chat", proxy_argo_chat_directly)
-app.router.add_post("/v1/embed", proxy_embedding_directly)
-
-# openai compatible
-app.router.add_post("/v1/chat/completions", proxy_openai_chat_compatible)
-app.router.add_post("/v1/completions", proxy_openai_legacy_completions_compatible)
-app.router.add_post("/v1/responses", proxy_openai_responses_request)
-app.router.add_post("/v1/embeddings", proxy_openai_embedding_request)
-app.router.add_get("/v1/models", get_models)
-
-# extras
-app.router.add_get("/v1/docs", docs)
-app.router.add_get("/health", health_check)
-app.router.add_get("/version", get_version)
-
-
-def run(*, host: str = "0.0.0.0", port: int = 8080):
-    web.run_app(app, host=host, port=port)
+def create_app(
+    config: Optional[ArgoConfig] = None, config_path: Optional[str] = None
+) -> web.Application:
+    """Create the proxy application.
+
+    Args:
+        config: The validated configuration. If None, it is loaded from
+            `CONFIG_PATH` or the default locations on startup.
+        config_path: The file to read on reload, `CONFIG_PATH` or the
+            default locations if None.
+    """
+    server = config.server if config else ServerConfig()
+    app = web.Application(
+        middlewares=[metrics_middleware, snapshot_middleware, rate_limit_middleware],
+        client_max_size=server.client_max_size,
+    )
+    app["runtime"] = Runtime(config)
+    app["config_path"] = config_path
+    app["metrics"] = ProxyMetrics()
+
+    app.on_startup.append(setup_config)
+    app.on_startup.append(setup_tokenizers)
+    app.on_startup.append(setup_session)
+    app.on_startup.append(setup_model_catalog)
+    app.on_startup.append(setup_streams)
+    app.on_startup.append(setup_ratelimiter)
+    app.on_cleanup.append(cleanup_model_catalog)
+    app.on_cleanup.append(cleanup_streams)
+    app.on_cleanup.append(cleanup_session)
+
+    # openai incompatible
+    app.router.add_post("/v1/chat", proxy_argo_chat_directly)
+    app.router.add_post("/v1/embed", proxy_embedding_directly)
+
+    # openai compatible
+    app.router.add_post("/v1/chat/completions", proxy_openai_chat_compatible)
+    app.router.add_post("/v1/completions", proxy_openai_legacy_completions_compatible)
+    app.router.add_post("/v1/responses", proxy_openai_responses_request)
+    app.router.add_post("/v1/embeddings", proxy_openai_embedding_request)
+    app.router.add_get("/v1/models", get_models)
+    app.router.add_get("/v1/streams/{stream_id}", resume_stream)
+
+    # extras
+    app.router.add_get("/v1/docs", docs)
+    app.router.add_get("/health", health_check)
+    app.router.add_get("/version", get_version)
+    app.router.add_get("/metrics", get_metrics)
+    app.router.add_post("/admin/reload", admin_reload)
+
+    return app
+
+
+app = create_app()
+
+
+def run(
+    config: ArgoConfig, config_path: Optional[str] = None, check_urls: bool = False
+):
+    """Serves the proxy until it is stopped.
+
+    Args:
+        config: The validated configuration.
+        config_path: The file to read on reload.
+        check_urls: Whether to check the upstream URLs once serving, if
+            `validate_config` did not.
+    """
+    app = create_app(config, config_path)
+    start_checks, stop_checks = background_checks(check_urls)
+    app.on_startup.append(start_checks)
+    app.on_cleanup.append(stop_checks)
+    run_server(
+        app,
+        config.server,
+        host=config.host,
+        port=config.port,
+    )
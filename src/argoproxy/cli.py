@@ -9,17 +9,28 @@ from typing import Optional
 from loguru import logger
 
 from .__init__ import __version__
-from .app import run
 from .config import PATHS_TO_TRY, validate_config
-from .endpoints.extras import get_latest_pypi_version
 
-logger.remove()  # Remove default handlers
-logger.add(
-    sys.stdout,
-    colorize=True,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{message}</level>",
-    level="INFO",
-)
+# The server modules (aiohttp, endpoints, types) are imported by the
+# commands that need them, so --version, --edit and --validate start fast
+
+LOG_FORMAT = "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{message}</level>"
+
+
+def log_to_stdout(enqueue: bool = False) -> None:
+    """
+    Sends the logs to stdout, replacing the default handlers. With `enqueue`,
+    a background thread writes them, so a slow stdout does not block the
+    event loop; only the server needs it, so the other commands do not pay
+    for importing multiprocessing and starting the thread.
+    """
+    logger.remove()
+    logger.add(
+        sys.stdout, colorize=True, format=LOG_FORMAT, level="INFO", enqueue=enqueue
+    )
+
+
+log_to_stdout()
 
 
 def parsing_args() -> argparse.Namespace:
@@ -84,6 +95,26 @@ def parsing_args() -> argparse.Namespace:
         action="store_true",  # Changed from 'version' to 'store_true'
         help="Show the version and check for updates",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes sharing the port via SO_REUSEPORT",
+    )
+    parser.add_argument(
+        "--fast-start",
+        "-f",
+        action="store_true",
+        help="Check the upstream URLs in the background once the server is up, "
+        "instead of before starting it",
+    )
+    parser.add_argument(
+        "--bundle-tiktoken",
+        metavar="DIR",
+        type=str,
+        help="Download the tiktoken encodings into DIR for offline use and exit",
+    )
 
     args = parser.parse_args()
 
@@ -123,13 +154,10 @@ def open_in_editor(config_path: Optional[str] = None):
 
 
 def version_check():
-    latest = asyncio.run(get_latest_pypi_version())
+    from .version import check_version
+
     logger.info(f"Argo-Proxy version: {__version__}")
-    if latest and latest != __version__:
-        logger.warning(
-            f"New version available: {latest} (you have {__version__}). "
-            "Run 'pip install --upgrade argo-proxy' to update."
-        )
+    asyncio.run(check_version())
 
 
 def main():
@@ -141,17 +169,34 @@ def main():
     if args.version:  # Add version check when --version is used
         version_check()
         return
+    if args.bundle_tiktoken:
+        from .utils import bundle_tiktoken_encodings
+
+        bundle_tiktoken_encodings(args.bundle_tiktoken)
+        return
 
     set_config_envs(args)
 
     try:
         # Validate config in main process only
-        version_check()
-        config_instance = validate_config(args.config, args.show)
+        logger.info(f"Argo-Proxy version: {__version__}")
+        # --validate is meant to check the URLs, before anything else
+        check_urls = args.validate or not args.fast_start
+        config_instance = validate_config(args.config, args.show, check_urls)
         if args.validate:
             logger.info("Configuration validation successful.")
             return
-        run(host=config_instance.host, port=config_instance.port)
+        log_to_stdout(enqueue=True)
+        if args.workers > 1:
+            from .workers import run_workers
+
+            run_workers(
+                config_instance, args.workers, args.config, check_urls=not check_urls
+            )
+        else:
+            from .app import run
+
+            run(config_instance, args.config, check_urls=not check_urls)
     except KeyError:
         logger.error("Port not specified in configuration file.")
         sys.exit(1)
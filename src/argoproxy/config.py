@@ -1,15 +1,17 @@
+import asyncio
 import json
 import os
 import urllib
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, field
 from hashlib import md5
 from pathlib import Path
-from typing import Any, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import yaml  # type: ignore
 from loguru import logger
 
-from .utils import get_random_port, is_port_available, make_bar
+from .models import ModelRegistry, get_registry
+from .utils import USAGE_MODES, get_random_port, is_port_available, make_bar
 
 PATHS_TO_TRY = [
     "./config.yaml",
@@ -17,6 +19,41 @@ PATHS_TO_TRY = [
     os.path.expanduser("~/.argoproxy/config.yaml"),
 ]
 
+# Event loops the server can run on, see ServerConfig.loop
+EVENT_LOOPS = ("auto", "uvloop", "asyncio")
+
+
+@dataclass
+class ServerConfig:
+    """Settings of the HTTP server, the `server:` section of the config."""
+
+    # Event loop: "uvloop", "asyncio", or "auto" to use uvloop if installed
+    loop: str = "auto"
+    # Connections waiting to be accepted before new ones are refused
+    backlog: int = 128
+    # Seconds an idle keep-alive connection stays open
+    keepalive_timeout: float = 75.0
+    # Largest request body accepted, in bytes
+    client_max_size: int = 1024**2
+    # Log a line per request
+    access_log: bool = False
+    # aiohttp access log format, or "json" for a JSON object per request
+    access_log_format: str = '%a %t "%r" %s %b %Tfs'
+    # Seconds the server keeps accepting after SIGTERM while /health reports draining
+    drain_delay: float = 0.0
+    # Seconds in-flight requests and streams get to finish after the server stopped accepting
+    drain_timeout: float = 60.0
+    # Let another process bind the port while this one drains (SO_REUSEPORT)
+    reuse_port: bool = False
+
+    @classmethod
+    def from_dict(cls, config_dict: dict):
+        """Create ServerConfig instance from the `server:` section."""
+        unknown = set(config_dict) - set(cls.__annotations__)
+        if unknown:
+            raise ValueError(f"Unknown server options: {', '.join(sorted(unknown))}")
+        return cls(**config_dict)
+
 
 @dataclass
 class ArgoConfig:
@@ -41,6 +78,61 @@ class ArgoConfig:
         "https://apps.inside.anl.gov/argoapi/api/v1/resource/embed/"
     )
     verbose: bool = True
+    # Characters of each string kept in payloads logged by verbose, 0 keeps all
+    verbose_max_string: int = 1000
+    # Characters of each payload logged by verbose, 0 logs it whole
+    verbose_max_payload: int = 20000
+    # Per-route ("/v1/...") fraction of requests whose payloads verbose logs
+    verbose_sample_rates: dict = field(default_factory=dict)
+    # Bytes of a stream kept in memory before spilling to a temp file
+    stream_spill_threshold: int = 1024 * 1024
+    # Seconds a finished stream can still be resumed via Last-Event-ID, 0 disables
+    stream_replay_ttl: int = 60
+    # Seconds an abandoned resumable stream keeps generating before it is cancelled
+    stream_resume_grace: float = 10.0
+    # Share one upstream stream between identical deterministic requests
+    stream_coalescing: bool = False
+    # Seconds without upstream bytes before a keep-alive SSE comment, 0 disables
+    stream_heartbeat_interval: float = 15.0
+    # Per-model overrides of stream_heartbeat_interval, keyed by any model name
+    stream_heartbeat_models: dict = field(default_factory=dict)
+    # Also send heartbeats on the byte-exact raw /v1/chat passthrough
+    stream_heartbeat_raw: bool = False
+    # Local directory holding tiktoken encoding files, for hosts without internet
+    tiktoken_cache_dir: str = ""
+    # How `usage` token counts are obtained: "exact", "estimate" or "off"
+    usage_mode: str = "exact"
+    # Per-model or per-route ("/v1/...") overrides of usage_mode
+    usage_mode_overrides: dict = field(default_factory=dict)
+    # Per-model overrides of the context window in tokens, 0 disables the check
+    context_lengths: dict = field(default_factory=dict)
+    # URL or file of a model catalog adding to the built-in models, see models.py
+    model_catalog: str = ""
+    # Seconds between reads of model_catalog, 0 reads it at startup only
+    model_catalog_refresh: float = 3600.0
+    # Requests a worker serves before being replaced (with --workers), 0 disables
+    worker_max_requests: int = 0
+    # Requests per minute allowed per client, 0 disables
+    rate_limit_rpm: int = 0
+    # Prompt and completion tokens per minute allowed per client, 0 disables
+    rate_limit_tpm: int = 0
+    # Identify rate-limited clients by "api_key" (falling back to IP) or "ip"
+    rate_limit_key: str = "api_key"
+    # Bearer token required by the /admin endpoints, which are off if empty
+    admin_token: str = ""
+    # HTTP server settings
+    server: ServerConfig = field(default_factory=ServerConfig)
+
+    def __post_init__(self):
+        if self.server is None:  # an empty `server:` section
+            self.server = ServerConfig()
+        elif isinstance(self.server, dict):
+            self.server = ServerConfig.from_dict(self.server)
+        elif not isinstance(self.server, ServerConfig):
+            raise ValueError("server must be a mapping")
+        # Per-model overrides keyed by Argo model name, see _model_overrides
+        self._overrides: Dict[str, Dict[str, Any]] = {}
+        self._overrides_registry: Optional[ModelRegistry] = None
 
     @classmethod
     def from_dict(cls, config_dict: dict):
@@ -51,9 +143,84 @@ class ArgoConfig:
         """Convert ArgoConfig instance to a dictionary."""
         return asdict(self)
 
-    def validate(self) -> bool:
+    def heartbeat_interval(self, model: str, raw: bool = False) -> Optional[float]:
+        """Seconds between keep-alive comments on streams of `model`, None if off.
+
+        Args:
+            model (str): The resolved model name of the stream.
+            raw (bool): Whether the stream is the raw `/v1/chat` passthrough.
+        """
+        if raw and not self.stream_heartbeat_raw:
+            return None
+        interval = self._model_overrides("stream_heartbeat_models").get(
+            model, self.stream_heartbeat_interval
+        )
+        return interval or None
+
+    def verbose_sample_rate(self, route: str) -> float:
+        """Fraction of the requests on `route` whose payloads are logged.
+
+        Args:
+            route (str): The request path, e.g. "/v1/embeddings".
+        """
+        if not self.verbose:
+            return 0.0
+        return self.verbose_sample_rates.get(route, 1.0)
+
+    def token_usage_mode(self, model: str, route: str) -> str:
+        """Usage mode for requests of `model` on `route`.
+
+        A model override takes precedence over a route override, which takes
+        precedence over `usage_mode`.
+
+        Args:
+            model (str): The resolved model name of the request.
+            route (str): The request path, e.g. "/v1/chat/completions".
+        """
+        mode = self.usage_mode_overrides.get(route, self.usage_mode)
+        return self._model_overrides("usage_mode_overrides").get(model, mode)
+
+    def context_length(self, model: str) -> Optional[int]:
+        """Context window of `model` in tokens, None if unknown or unchecked.
+
+        Args:
+            model (str): The resolved model name of the request.
+        """
+        info = get_registry().get(model)
+        length = info.context_length if info is not None else None
+        length = self._model_overrides("context_lengths").get(model, length)
+        return length or None
+
+    def _model_overrides(self, setting: str) -> Dict[str, Any]:
+        """The per-model overrides in `setting`, keyed by Argo model name.
+
+        Overrides may name a model by any alias. They are resolved once per
+        model registry, rather than on every request.
+
+        Args:
+            setting (str): The name of a per-model overrides setting.
+        """
+        registry = get_registry()
+        if self._overrides_registry is not registry:
+            self._overrides, self._overrides_registry = {}, registry
+        overrides = self._overrides.get(setting)
+        if overrides is None:
+            overrides = {
+                registry.canonical(name): value
+                for name, value in getattr(self, setting).items()
+                if not name.startswith("/")  # route overrides of usage_mode
+            }
+            self._overrides[setting] = overrides
+        return overrides
+
+    def validate(self, check_urls: bool = True) -> bool:
         """Validate and patch all configuration aspects.
 
+        Args:
+            check_urls (bool): Whether to check the upstream URLs by sending
+                them a request. They can instead be checked in the background
+                once the server is up, see `check_urls`.
+
         Returns:
             bool: True if configuration changed after validation. False otherwise.
         """
@@ -67,19 +234,41 @@ class ArgoConfig:
         # Then validate and patch individual components
         self._validate_user()  # Handles empty user
         self._validate_port()  # Handles invalid port
-        self._validate_urls()  # Handles URL validation with skip option
+        if check_urls:
+            self._validate_urls()  # Handles URL validation with skip option
         self._get_verbose()  # Handles verbose flag
+        self.check()  # Rejects invalid values of the other settings
         hash_after_validation = md5(json.dumps(self.to_dict()).encode()).hexdigest()
 
         return hash_original != hash_after_validation
 
+    def check(self) -> None:
+        """Validate the settings that need no user interaction.
+
+        Raises:
+            ValueError: If a setting is invalid.
+        """
+        if not self.user:
+            raise ValueError("Missing required configuration: 'user'")
+        for url in (self.argo_url, self.argo_stream_url, self.argo_embedding_url):
+            if not url.startswith(("http://", "https://")):
+                raise ValueError(f"Invalid URL format: {url}")
+        self._validate_usage_modes()  # Rejects unknown usage modes
+        self._validate_verbose()  # Rejects invalid payload logging limits
+        self._validate_rate_limits()  # Rejects invalid rate limits
+        self._validate_server()  # Rejects invalid server settings
+        if self.model_catalog_refresh < 0:
+            raise ValueError("model_catalog_refresh must not be negative")
+
     def _validate_user(self) -> None:
         """Validate and update the user attribute using the helper function."""
         self.user = _get_valid_username(self.user)
 
     def _validate_port(self) -> None:
         """Validate and patch the port attribute."""
-        if self.port and is_port_available(self.port):
+        if self.port and is_port_available(
+            self.port, reuse_port=self.server.reuse_port
+        ):
             logger.info(f"Using port {self.port}...")
             return  # Valid port already set
 
@@ -93,8 +282,12 @@ class ArgoConfig:
         )
         logger.info(f"Using port {self.port}...")
 
-    def _validate_urls(self) -> None:
-        """Validate URL connectivity with option to skip failures."""
+    async def check_urls(self) -> List[str]:
+        """Send a test request to each upstream URL, all at once.
+
+        Returns:
+            List[str]: The errors found, empty if all URLs answered.
+        """
         required_urls: list[tuple[str, dict[str, Any]]] = [
             (
                 self.argo_url,
@@ -106,18 +299,22 @@ class ArgoConfig:
             (self.argo_embedding_url, {"model": "v3small", "prompt": ["hello"]}),
         ]
 
-        logger.info("Validating URL connectivity...")
-        errors = []
-
-        for url, payload in required_urls:
+        async def check(url: str, payload: dict) -> Optional[str]:
             if not url.startswith(("http://", "https://")):
-                errors.append(f"Invalid URL format: {url}")
-                continue
-
+                return f"Invalid URL format: {url}"
             try:
-                validate_api(url, self.user, payload)
+                await asyncio.to_thread(validate_api, url, self.user, payload)
             except Exception as e:
-                errors.append(f"{url}: {str(e)}")
+                return f"{url}: {str(e)}"
+            return None
+
+        errors = await asyncio.gather(*(check(*args) for args in required_urls))
+        return [error for error in errors if error]
+
+    def _validate_urls(self) -> None:
+        """Validate URL connectivity with option to skip failures."""
+        logger.info("Validating URL connectivity...")
+        errors = asyncio.run(self.check_urls())
 
         if errors:
             logger.error("URL validation errors:")
@@ -130,6 +327,63 @@ class ArgoConfig:
                 raise ValueError("URL validation aborted by user")
             logger.info("Continuing with configuration despite URL issues...")
 
+    def _validate_usage_modes(self) -> None:
+        """Ensure usage_mode and its overrides are known modes."""
+        modes = {"usage_mode": self.usage_mode}
+        modes.update(self.usage_mode_overrides)
+        for name, mode in modes.items():
+            if mode not in USAGE_MODES:
+                raise ValueError(
+                    f"Invalid usage mode '{mode}' for '{name}', "
+                    f"expected one of {', '.join(USAGE_MODES)}"
+                )
+
+    def _validate_verbose(self) -> None:
+        """Ensure the payload logging limits and sample rates are in range."""
+        if self.verbose_max_string < 0 or self.verbose_max_payload < 0:
+            raise ValueError(
+                "verbose_max_string and verbose_max_payload must not be negative"
+            )
+        for route, rate in self.verbose_sample_rates.items():
+            if not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+                raise ValueError(
+                    f"Invalid sample rate {rate} for '{route}', expected 0 to 1"
+                )
+
+    def _validate_rate_limits(self) -> None:
+        """Ensure rate limits are non-negative and the client key is known."""
+        if self.rate_limit_rpm < 0 or self.rate_limit_tpm < 0:
+            raise ValueError("rate_limit_rpm and rate_limit_tpm must not be negative")
+        if self.rate_limit_key not in ("api_key", "ip"):
+            raise ValueError(
+                f"Invalid rate_limit_key '{self.rate_limit_key}', "
+                "expected 'api_key' or 'ip'"
+            )
+
+    def _validate_server(self) -> None:
+        """Ensure the server settings are usable."""
+        if self.server.loop not in EVENT_LOOPS:
+            raise ValueError(
+                f"Invalid server.loop '{self.server.loop}', "
+                f"expected one of {', '.join(EVENT_LOOPS)}"
+            )
+        if self.server.backlog <= 0 or self.server.client_max_size <= 0:
+            raise ValueError(
+                "server.backlog and server.client_max_size must be positive"
+            )
+        if (
+            min(
+                self.server.keepalive_timeout,
+                self.server.drain_delay,
+                self.server.drain_timeout,
+            )
+            < 0
+        ):
+            raise ValueError(
+                "server.keepalive_timeout, server.drain_delay and "
+                "server.drain_timeout must not be negative"
+            )
+
     def _get_verbose(self) -> None:
         """
         Toggle verbose mode based on existing settings or user input.
@@ -154,7 +408,10 @@ class ArgoConfig:
 
     def __str__(self) -> str:
         """Provide a formatted string representation for logger.infoing."""
-        return json.dumps(self.to_dict(), indent=4)
+        config_dict = self.to_dict()
+        if config_dict["admin_token"]:
+            config_dict["admin_token"] = "****"  # keep it out of the logs
+        return json.dumps(config_dict, indent=4)
 
     def show(self, message: Optional[str] = None) -> None:
         """
@@ -402,9 +659,17 @@ def load_config(
 
 
 def validate_config(
-    optional_path: Optional[str] = None, show_config: bool = False
+    optional_path: Optional[str] = None,
+    show_config: bool = False,
+    check_urls: bool = True,
 ) -> ArgoConfig:
-    """Validate configuration with user interaction if needed"""
+    """Validate configuration with user interaction if needed
+
+    Args:
+        optional_path: The config file, the default locations if None.
+        show_config: Whether to show the configuration.
+        check_urls: Whether to check the upstream URLs before returning.
+    """
     config_data, actual_path = load_config(optional_path)
 
     if not config_data:
@@ -420,7 +685,7 @@ def validate_config(
             exit(1)
 
     # Config may change here. We need to persist
-    file_changed = config_data.validate()
+    file_changed = config_data.validate(check_urls)
     if file_changed:
         config_original, _ = load_config(actual_path, env_override=False)
         if not config_original:
@@ -19,6 +19,7 @@ _EMBED_MODELS = {
     "v3large": "argo:text-embedding-3-large",
 }
 
+
 # Create flattened mappings for lookup
 def flatten_mapping(mapping):
     flat = {}
@@ -44,3 +45,25 @@ TIKTOKEN_ENCODING_PREFIX_MAPPING = {
     "ada002": "cl100k_base",  # embedding
     "v3": "cl100k_base",  # embedding
 }
+
+# Prefixes of the chat models that take no system messages; theirs are sent
+# as user messages
+NO_SYSTEM_MESSAGE_PREFIXES = ("gpto",)  # o-series
+
+# Context window of each model in tokens, prompt and completion together
+MODEL_CONTEXT_LENGTHS = {
+    "gpt35": 4096,
+    "gpt35large": 16384,
+    "gpt4": 8192,
+    "gpt4large": 32768,
+    "gpt4turbo": 128000,
+    "gpt4o": 128000,
+    "gpt4olatest": 128000,
+    "gpto1mini": 128000,
+    "gpto3mini": 200000,
+    "gpto1": 200000,
+    "gpto1preview": 128000,
+    "ada002": 8191,
+    "v3small": 8191,
+    "v3large": 8191,
+}
@@ -1,16 +1,36 @@
-import fnmatch
 import json
 import time
 import uuid
 from http import HTTPStatus
-from typing import Any, Callable, Dict, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import aiohttp
 from aiohttp import web
 from loguru import logger
 
 from ..config import ArgoConfig
-from ..constants import CHAT_MODELS
+from ..metrics import (
+    StreamMetrics,
+    record_prompt_tokens,
+    server_timing_comment,
+    set_request_model,
+    timed,
+)
+from ..models import get_registry
+from ..ratelimit import (
+    charge_completion_tokens,
+    charging_completion,
+    completion_usage_mode,
+    counts_completion_tokens,
+)
+from ..streaming import (
+    StreamBuffer,
+    StreamRegistry,
+    await_upstream,
+    join_stream,
+    serve_stream,
+    start_producer,
+)
 from ..types import (
     ChatCompletion,
     ChatCompletionChunk,
@@ -21,27 +41,17 @@ from ..types import (
     StreamChoice,
 )
 from ..utils import (
-    calculate_prompt_tokens,
+    StreamStopper,
+    calculate_prompt_tokens_async,
     count_tokens,
-    make_bar,
-    resolve_model_name,
+    count_tokens_async,
+    extract_text_content,
+    log_payload,
     send_off_sse,
 )
 
 DEFAULT_MODEL = "gpt4o"
 
-NO_SYS_MSG_PATTERNS = {
-    "^argo:gpt-o.*$",
-    "^argo:o.*$",
-    "^gpto.*$",
-}
-
-NO_SYS_MSG = [
-    model
-    for model in CHAT_MODELS
-    if any(fnmatch.fnmatch(model, pattern) for pattern in NO_SYS_MSG_PATTERNS)
-]
-
 
 def make_it_openai_chat_completions_compat(
     custom_response: Any,
@@ -50,6 +60,7 @@ def make_it_openai_chat_completions_compat(
     prompt_tokens: int,
     is_streaming: bool = False,
     finish_reason: Optional[str] = None,
+    completion_tokens: Optional[int] = None,
 ) -> Dict[str, Any]:
     """
     Transforms the custom API response into a format compatible with OpenAI's API.
@@ -61,6 +72,7 @@ def make_it_openai_chat_completions_compat(
         prompt_tokens: The number of tokens in the input prompt.
         is_streaming: Boolean indicating if the response is streaming.
         finish_reason: The reason for response completion, e.g., "stop".
+        completion_tokens: The number of tokens in the response, if already counted.
 
     Returns:
         A dictionary representing the OpenAI-compatible JSON response.
@@ -78,7 +90,8 @@ def make_it_openai_chat_completions_compat(
         if not is_streaming:
             # only count usage if not stream
             # Calculate token counts (simplified example, actual tokenization may differ)
-            completion_tokens = count_tokens(response_text, model_name)
+            if completion_tokens is None:
+                completion_tokens = count_tokens(response_text, model_name)
             total_tokens = prompt_tokens + completion_tokens
             usage = CompletionUsage(
                 prompt_tokens=prompt_tokens,
@@ -97,7 +110,7 @@ def make_it_openai_chat_completions_compat(
                         delta=ChoiceDelta(
                             content=response_text,
                         ),
-                        finish_reason=finish_reason or "stop",
+                        finish_reason=finish_reason,  # None for ongoing chunks
                     )
                 ],
             )
@@ -141,24 +154,23 @@ def prepare_request_data(
     Returns:
         The modified and prepared request data.
     """
-    config: ArgoConfig = request.app["config"]
+    config: ArgoConfig = request["config"]
     # Automatically replace or insert the user
     data["user"] = config.user
 
-    # Remap the model using MODEL_AVAIL
-    if "model" in data:
-        data["model"] = resolve_model_name(
-            data["model"], DEFAULT_MODEL, avail_models=CHAT_MODELS
-        )
-    else:
-        data["model"] = DEFAULT_MODEL
+    # Remap the model using the model registry
+    model = get_registry().resolve(
+        data.get("model", DEFAULT_MODEL), "chat", DEFAULT_MODEL
+    )
+    data["model"] = model.name
+    set_request_model(model.name)
 
     # Convert prompt to list if it's not already
     if "prompt" in data and not isinstance(data["prompt"], list):
         data["prompt"] = [data["prompt"]]
 
     # Convert system message to user message for specific models
-    if data["model"] in NO_SYS_MSG:
+    if not model.system_message:
         if "messages" in data:
             for message in data["messages"]:
                 if message["role"] == "system":
@@ -170,12 +182,97 @@ def prepare_request_data(
                 raise ValueError("System prompt must be a string or list")
             data["prompt"] = data["system"] + data["prompt"]
             del data["system"]
-            if config.verbose:
-                logger.info(f"New data is {data}")
+            log_payload(request, "[chat] new data", data)
 
     return data
 
 
+async def fit_context_window(data: Dict[str, Any], request: web.Request) -> None:
+    """
+    Checks that the prompt and the requested completion fit the model's
+    context window before the request is sent upstream.
+
+    With `truncation: "auto"` the oldest non-system messages are dropped
+    until the prompt fits; otherwise an oversized request is rejected.
+
+    Args:
+        data: The prepared request data, modified in place.
+        request: The incoming web request object.
+
+    Raises:
+        ValueError: If the request does not fit the context window.
+    """
+    config: ArgoConfig = request["config"]
+    # Not supported upstream, the proxy truncates itself
+    truncation = data.pop("truncation", None)
+
+    model = data["model"]
+    context_length = config.context_length(model)
+    if context_length is None:
+        return
+
+    mode = config.token_usage_mode(model, request.path)
+    # The check still needs a count when usage is not reported
+    mode = "estimate" if mode == "off" else mode
+    max_tokens = data.get("max_tokens") or data.get("max_completion_tokens") or 0
+    budget = context_length - max_tokens
+
+    prompt_tokens = await calculate_prompt_tokens_async(data, model, mode)
+    if prompt_tokens > budget and truncation == "auto" and data.get("messages"):
+        prompt_tokens = await _drop_oldest_messages(data, budget, mode)
+
+    if prompt_tokens > budget:
+        raise ValueError(
+            f"This model's maximum context length is {context_length} tokens. "
+            f"However, you requested {prompt_tokens + max_tokens} tokens "
+            f"({prompt_tokens} in the messages, {max_tokens} in the completion). "
+            "Please reduce the length of the messages or completion, "
+            'or set "truncation": "auto".'
+        )
+
+
+async def _drop_oldest_messages(data: Dict[str, Any], budget: int, mode: str) -> int:
+    """
+    Drops the oldest conversation turns until the prompt fits `budget`
+    tokens. A turn is a user message with the assistant replies and tool
+    results that follow it, so no reply is left without its question.
+    System and developer messages and the latest turn are always kept.
+
+    Returns:
+        The prompt token count after truncation.
+    """
+    messages = data["messages"]
+    counts = [
+        await count_tokens_async(
+            extract_text_content(message.get("content") or ""), data["model"], mode
+        )
+        for message in messages
+    ]
+    total = sum(counts)
+
+    turns: List[List[int]] = []
+    for index, message in enumerate(messages):
+        if message.get("role") in ("system", "developer"):
+            continue
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(index)
+
+    dropped = set()
+    for turn in turns[:-1]:
+        if total <= budget:
+            break
+        dropped.update(turn)
+        total -= sum(counts[index] for index in turn)
+
+    if dropped:
+        data["messages"] = [m for i, m in enumerate(messages) if i not in dropped]
+        logger.warning(
+            f"Dropped {len(dropped)} oldest messages to fit {budget} prompt tokens"
+        )
+    return total
+
+
 async def send_non_streaming_request(
     session: aiohttp.ClientSession,
     api_url: str,
@@ -184,6 +281,7 @@ async def send_non_streaming_request(
     openai_compat_fn: Callable[
         ..., Dict[str, Any]
     ] = make_it_openai_chat_completions_compat,
+    usage_mode: str = "exact",
 ) -> web.Response:
     """Sends a non-streaming request to an API and processes the response.
 
@@ -193,35 +291,50 @@ async def send_non_streaming_request(
         data: The JSON payload of the request.
         convert_to_openai: If True, converts the response to OpenAI format.
         openai_compat_fn: Function for conversion to OpenAI-compatible format.
+        usage_mode: How usage tokens are counted, see ArgoConfig.usage_mode.
 
     Returns:
         A web.Response with the processed JSON data.
     """
     headers = {"Content-Type": "application/json"}
     async with session.post(api_url, headers=headers, json=data) as upstream_resp:
-        response_data = await upstream_resp.json()
+        with timed("body"):
+            response_data = await upstream_resp.json()
         upstream_resp.raise_for_status()
 
         if convert_to_openai:
-            # Calculate prompt tokens using the unified function
-            prompt_tokens = calculate_prompt_tokens(data, data["model"])
-            openai_response = openai_compat_fn(
-                json.dumps(response_data),
-                model_name=data.get("model"),
-                create_timestamp=int(time.time()),
-                prompt_tokens=prompt_tokens,
-            )
-            return web.json_response(
-                openai_response,
-                status=upstream_resp.status,
-                content_type="application/json",
-            )
+            # Count tokens off the event loop for large prompts and responses
+            with timed("tokenize"):
+                prompt_tokens = await calculate_prompt_tokens_async(
+                    data, data["model"], usage_mode
+                )
+                completion_tokens = await count_tokens_async(
+                    response_data.get("response", ""),
+                    data["model"],
+                    completion_usage_mode(usage_mode),
+                )
+            record_prompt_tokens(prompt_tokens)
+            charge_completion_tokens(completion_tokens)
+            with timed("convert"):
+                openai_response = openai_compat_fn(
+                    json.dumps(response_data),
+                    model_name=data.get("model"),
+                    create_timestamp=int(time.time()),
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                )
+                return web.json_response(
+                    openai_response,
+                    status=upstream_resp.status,
+                    content_type="application/json",
+                )
         else:
-            return web.json_response(
-                response_data,
-                status=upstream_resp.status,
-                content_type="application/json",
-            )
+            with timed("convert"):
+                return web.json_response(
+                    response_data,
+                    status=upstream_resp.status,
+                    content_type="application/json",
+                )
 
 
 async def send_streaming_request(
@@ -250,53 +363,146 @@ async def send_streaming_request(
         "Accept-Encoding": "identity",
     }
 
-    # Set response headers based on the mode
-    if convert_to_openai:
-        response_headers = {"Content-Type": "text/event-stream"}
-        created_timestamp = int(time.time())
-        prompt_tokens = calculate_prompt_tokens(data, data["model"])
-    else:
-        response_headers = {"Content-Type": "text/plain; charset=utf-8"}
+    config: ArgoConfig = request["config"]
+    registry: StreamRegistry = request.app["streams"]
 
-    async with session.post(api_url, headers=headers, json=data) as upstream_resp:
-        # Initialize the streaming response
-        response_headers.update(
-            {
-                k: v
-                for k, v in upstream_resp.headers.items()
-                if k.lower()
-                not in ("content-type", "content-encoding", "transfer-encoding")
-            }
+    heartbeat = config.heartbeat_interval(data["model"], raw=not convert_to_openai)
+    # Identical deterministic requests share a single upstream stream
+    key = registry.coalescing_key(request.path, data) if convert_to_openai else None
+    live, response = await join_stream(request, registry, key, heartbeat)
+    if live is not None:
+        return await serve_stream(request, registry, live, response=response)
+
+    try:
+        # Set response headers based on the mode
+        if convert_to_openai:
+            response_headers = {"Content-Type": "text/event-stream"}
+            created_timestamp = int(time.time())
+            usage_mode = config.token_usage_mode(data["model"], request.path)
+            with timed("tokenize"):
+                prompt_tokens = await calculate_prompt_tokens_async(
+                    data, data["model"], usage_mode
+                )
+            record_prompt_tokens(prompt_tokens)
+        else:
+            response_headers = {"Content-Type": "text/plain; charset=utf-8"}
+
+        upstream_resp, response = await await_upstream(
+            request,
+            session.post(api_url, headers=headers, json=data),
+            response_headers,
+            heartbeat,
+            sse=convert_to_openai,
+            response=response,
         )
-        response = web.StreamResponse(
-            status=upstream_resp.status,
-            headers=response_headers,
+    except BaseException:
+        registry.abandon(key)
+        raise
+    if upstream_resp is None:
+        # Failed after heartbeats started; the error was sent in the stream
+        registry.abandon(key)
+        return response
+
+    stream_buffer = StreamBuffer(config.stream_spill_threshold)
+
+    if convert_to_openai:
+        stream_options = data.get("stream_options") or {}
+        include_usage = bool(stream_options.get("include_usage"))
+
+        # Enforce stop sequences and max_tokens even if the upstream does not
+        stopper = StreamStopper(
+            data["model"],
+            stop=data.get("stop"),
+            max_tokens=data.get("max_tokens") or data.get("max_completion_tokens"),
+            count_usage=include_usage or counts_completion_tokens(),
+            usage_mode=completion_usage_mode(usage_mode),
         )
-        response.enable_chunked_encoding()
-        await response.prepare(request)
+
+    timing = StreamMetrics(api_url, data["model"])
+
+    async def pump_upstream() -> None:
+        if not convert_to_openai:
+            # Return the chunks as-is (raw text)
+            async for chunk in upstream_resp.content.iter_any():
+                timing.chunk(chunk.decode(errors="ignore"))
+                await send_off_sse(stream_buffer, chunk)
+                timing.converted()
+            timing.finish()
+            return
+
+        def convert(text: str, finish_reason: Optional[str] = None) -> Dict[str, Any]:
+            # Convert the chunk to OpenAI-compatible JSON
+            return openai_compat_fn(
+                json.dumps({"response": text}),
+                model_name=data["model"],
+                create_timestamp=created_timestamp,
+                prompt_tokens=prompt_tokens,
+                is_streaming=True,
+                finish_reason=finish_reason,
+            )
 
         # Stream the response chunk by chunk
         async for chunk in upstream_resp.content.iter_any():
-            if convert_to_openai:
-                # Convert the chunk to OpenAI-compatible JSON
-                chunk_json = openai_compat_fn(
-                    json.dumps({"response": chunk.decode()}),
-                    model_name=data["model"],
-                    create_timestamp=created_timestamp,
-                    prompt_tokens=prompt_tokens,
-                    is_streaming=True,
-                    finish_reason=None,  # Ongoing chunk
-                )
+            text = chunk.decode()
+            timing.chunk(text)
+            text = stopper.feed(text)
+            if text or stopper.finish_reason:
                 # Wrap the JSON in SSE format
-                await send_off_sse(response, chunk_json)
-            else:
-                # Return the chunk as-is (raw text)
-                await send_off_sse(response, chunk)
+                await send_off_sse(stream_buffer, convert(text, stopper.finish_reason))
+            timing.converted()
+            if stopper.finish_reason:
+                # Leaving the upstream unread closes its connection
+                break
+        else:
+            # The upstream ended on its own: close the choice explicitly
+            text = stopper.flush()
+            await send_off_sse(
+                stream_buffer, convert(text, stopper.finish_reason or "stop")
+            )
+        timing.finish(stopper.completion_tokens)
 
-        # Ensure response is properly closed
-        await response.write_eof()
+        if include_usage:
+            # Trailing chunk with no choices, as OpenAI sends for include_usage
+            usage_chunk = convert("")
+            usage_chunk["choices"] = []
+            usage_chunk["usage"] = CompletionUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=stopper.completion_tokens,
+                total_tokens=prompt_tokens + stopper.completion_tokens,
+            ).model_dump()
+            await send_off_sse(stream_buffer, usage_chunk)
 
-        return response
+        if comment := server_timing_comment():
+            await stream_buffer.write(comment)
+
+    produce = pump_upstream()
+    if convert_to_openai:
+        # Completion tokens count against the client's rate limit once known
+        produce = charging_completion(produce, lambda: stopper.completion_tokens)
+
+    # Drain upstream at full speed; the client is fed from the buffer
+    producer = start_producer(produce, upstream_resp, stream_buffer)
+
+    # Initialize the streaming response
+    response_headers.update(
+        {
+            k: v
+            for k, v in upstream_resp.headers.items()
+            if k.lower()
+            not in ("content-type", "content-encoding", "transfer-encoding")
+        }
+    )
+    # SSE streams stay resumable through Last-Event-ID after a disconnect
+    live = registry.open(
+        stream_buffer,
+        producer,
+        upstream_resp.status,
+        response_headers,
+        resumable=convert_to_openai,
+        key=key,
+        heartbeat=heartbeat,
+    )
+    return await serve_stream(request, registry, live, response=response)
 
 
 async def proxy_request(
@@ -313,45 +519,49 @@ async def proxy_request(
     Returns:
         A web.Response or web.StreamResponse with the final response from the upstream API.
     """
-    config: ArgoConfig = request.app["config"]
+    config: ArgoConfig = request["config"]
 
     try:
         # Retrieve the incoming JSON data from request if input_data is not provided
 
-        data = await request.json()
+        with timed("parse"):
+            data = await request.json()
         stream = data.get("stream", False)
 
         if not data:
             raise ValueError("Invalid input. Expected JSON data.")
-        if config.verbose:
-            logger.info(make_bar("[chat] input"))
-            logger.info(json.dumps(data, indent=4))
-            logger.info(make_bar())
+        log_payload(request, "[chat] input", data)
 
         # Prepare the request data
-        data = prepare_request_data(data, request)
+        with timed("prepare"):
+            data = prepare_request_data(data, request)
+        with timed("tokenize"):
+            await fit_context_window(data, request)
 
         # Determine the API URL based on whether streaming is enabled
         api_url = config.argo_stream_url if stream else config.argo_url
 
         # Forward the modified request to the actual API using aiohttp
-        async with aiohttp.ClientSession() as session:
-            if stream:
-                return await send_streaming_request(
-                    session,
-                    api_url,
-                    data,
-                    request,
-                    convert_to_openai,
-                )
-            else:
-                return await send_non_streaming_request(
-                    session,
-                    api_url,
-                    data,
-                    convert_to_openai,
-                )
+        session: aiohttp.ClientSession = request["session"]
+        if stream:
+            return await send_streaming_request(
+                session,
+                api_url,
+                data,
+                request,
+                convert_to_openai,
+            )
+        else:
+            return await send_non_streaming_request(
+                session,
+                api_url,
+                data,
+                convert_to_openai,
+                usage_mode=config.token_usage_mode(data["model"], request.path),
+            )
 
+    except web.HTTPRequestEntityTooLarge:
+        raise  # server.client_max_size exceeded, answered with 413
     except ValueError as err:
         return web.json_response(
             {"error": str(err)},
@@ -5,16 +5,17 @@ from typing import Any, Dict, Optional, Union
 
 import aiohttp
 from aiohttp import web
-from loguru import logger
 
 from .chat import (
+    fit_context_window,
     prepare_request_data,
     send_non_streaming_request,
     send_streaming_request,
 )
 from ..config import ArgoConfig
+from ..metrics import timed
 from ..types import Completion, CompletionChoice, CompletionUsage
-from ..utils import make_bar
+from ..utils import log_payload
 
 DEFAULT_STREAM = False
 
@@ -26,6 +27,7 @@ def make_it_openai_completions_compat(
     prompt_tokens: int,
     is_streaming: bool = False,
     finish_reason: Optional[str] = None,
+    completion_tokens: Optional[int] = None,
 ) -> Union[Dict[str, Any], str]:
     """Converts a custom API response to an OpenAI-compatible completion API response.
 
@@ -36,6 +38,7 @@ def make_it_openai_completions_compat(
         prompt_tokens (int): Number of tokens in the input prompt.
         is_streaming (bool, optional): Indicates if the response is in streaming mode. Defaults to False.
         finish_reason (str, optional): Reason for the completion stop. Defaults to None.
+        completion_tokens (int, optional): Number of tokens in the response, if already counted.
 
     Returns:
         Union[Dict[str, Any], str]: OpenAI-compatible JSON response or an error message.
@@ -52,7 +55,8 @@ def make_it_openai_completions_compat(
 
         # Calculate token counts (simplified example, actual tokenization may differ)
         if not is_streaming:
-            completion_tokens: int = len(response_text.split())
+            if completion_tokens is None:
+                completion_tokens = len(response_text.split())
             total_tokens: int = prompt_tokens + completion_tokens
             usage = CompletionUsage(
                 prompt_tokens=prompt_tokens,
@@ -68,12 +72,15 @@ def make_it_openai_completions_compat(
                 CompletionChoice(
                     text=response_text,
                     index=0,
-                    finish_reason=finish_reason or "stop",
+                    # Ongoing stream chunks have no finish reason yet
+                    finish_reason=(
+                        finish_reason if is_streaming else finish_reason or "stop"
+                    ),
                 )
             ],
-            usage=usage
-            if not is_streaming
-            else None,  # Usage is not provided in streaming mode
+            usage=(
+                usage if not is_streaming else None
+            ),  # Usage is not provided in streaming mode
         )
 
         return openai_response.model_dump()
@@ -101,45 +108,49 @@ async def proxy_request(
         aiohttp.ClientError: Raised when there is an HTTP client error.
         Exception: Raised for unexpected runtime errors.
     """
-    config: ArgoConfig = request.app["config"]
+    config: ArgoConfig = request["config"]
     try:
         # Retrieve the incoming JSON data
-        data: Dict[str, Any] = await request.json()
+        with timed("parse"):
+            data: Dict[str, Any] = await request.json()
         stream: bool = data.get("stream", DEFAULT_STREAM)
 
         if not data:
             raise ValueError("Invalid input. Expected JSON data.")
-        if config.verbose:
-            logger.info(make_bar("[completion] input"))
-            logger.info(json.dumps(data, indent=4))
-            logger.info(make_bar())
+        log_payload(request, "[completion] input", data)
 
         # Prepare the request data
-        data = prepare_request_data(data, request)
+        with timed("prepare"):
+            data = prepare_request_data(data, request)
+        with timed("tokenize"):
+            await fit_context_window(data, request)
 
         # Determine the API URL based on whether streaming is enabled
         api_url: str = config.argo_stream_url if stream else config.argo_url
 
         # Forward the modified request to the actual API using aiohttp
-        async with aiohttp.ClientSession() as session:
-            if stream:
-                return await send_streaming_request(
-                    session,
-                    api_url,
-                    data,
-                    request,
-                    convert_to_openai=True,
-                    openai_compat_fn=make_it_openai_completions_compat,
-                )
-            else:
-                return await send_non_streaming_request(
-                    session,
-                    api_url,
-                    data,
-                    convert_to_openai=True,
-                    openai_compat_fn=make_it_openai_completions_compat,
-                )
+        session: aiohttp.ClientSession = request["session"]
+        if stream:
+            return await send_streaming_request(
+                session,
+                api_url,
+                data,
+                request,
+                convert_to_openai=True,
+                openai_compat_fn=make_it_openai_completions_compat,
+            )
+        else:
+            return await send_non_streaming_request(
+                session,
+                api_url,
+                data,
+                convert_to_openai=True,
+                openai_compat_fn=make_it_openai_completions_compat,
+                usage_mode=config.token_usage_mode(data["model"], request.path),
+            )
 
+    except web.HTTPRequestEntityTooLarge:
+        raise  # server.client_max_size exceeded, answered with 413
     except ValueError as err:
         return web.json_response(
             {"error": str(err)},
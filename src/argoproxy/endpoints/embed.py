@@ -1,15 +1,14 @@
 import json
 from http import HTTPStatus
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 import aiohttp
 from aiohttp import web
-from loguru import logger
 
 from ..config import ArgoConfig
-from ..constants import EMBED_MODELS
+from ..metrics import record_prompt_tokens, set_request_model, timed
 from ..types import CreateEmbeddingResponse, Embedding, Usage
-from ..utils import count_tokens, make_bar, resolve_model_name
+from ..utils import count_tokens, count_tokens_async, log_payload, resolve_model_name
 
 DEFAULT_MODEL = "v3small"
 
@@ -18,6 +17,7 @@ def make_it_openai_embeddings_compat(
     custom_response: Union[str, Dict[str, Any]],
     model_name: str,
     prompt: Union[str, List[str]],
+    prompt_tokens: Optional[int] = None,
 ) -> Union[Dict[str, Any], str]:
     """Converts a custom API response to an OpenAI-compatible response.
 
@@ -25,6 +25,7 @@ def make_it_openai_embeddings_compat(
         custom_response (Union[str, Dict[str, Any]]): JSON response from the custom API.
         model_name (str): The name of the model used for generating embeddings.
         prompt (Union[str, List[str]]): The input prompt or list of prompts used in the request.
+        prompt_tokens (Optional[int]): Number of tokens in the prompt, if already counted.
 
     Returns:
         Union[Dict[str, Any], str]: An OpenAI-compatible response or error message.
@@ -37,10 +38,11 @@ def make_it_openai_embeddings_compat(
             custom_response_dict = custom_response
 
         # Calculate token counts
-        if isinstance(prompt, str):
-            prompt_tokens = count_tokens(prompt, model_name)
-        else:
-            prompt_tokens = sum(count_tokens(text, model_name) for text in prompt)
+        if prompt_tokens is None:
+            if isinstance(prompt, str):
+                prompt_tokens = count_tokens(prompt, model_name)
+            else:
+                prompt_tokens = sum(count_tokens(text, model_name) for text in prompt)
 
         # Construct the OpenAI-compatible response
         data = [
@@ -75,24 +77,20 @@ async def proxy_request(
     Returns:
         web.Response: The HTTP response sent back to the client.
     """
-    config: ArgoConfig = request.app["config"]
+    config: ArgoConfig = request["config"]
     try:
         # Retrieve the incoming JSON data
-        data: Dict[str, Any] = await request.json()
+        with timed("parse"):
+            data: Dict[str, Any] = await request.json()
         if not data:
             raise ValueError("Invalid input. Expected JSON data.")
-        if config.verbose:
-            logger.info(make_bar("[embed] input"))
-            logger.info(json.dumps(data, indent=4))
-            logger.info(make_bar())
-
-        # Remap the model using EMBED_MODELS
-        if "model" in data:
-            data["model"] = resolve_model_name(
-                data["model"], DEFAULT_MODEL, avail_models=EMBED_MODELS
-            )
-        else:
-            data["model"] = DEFAULT_MODEL  # Default model if not provided
+        log_payload(request, "[embed] input", data)
+
+        # Remap the model using the model registry, the default if not provided
+        data["model"] = resolve_model_name(
+            data.get("model", DEFAULT_MODEL), DEFAULT_MODEL, kind="embed"
+        )
+        set_request_model(data["model"])
 
         # Transform the incoming payload to match the destination API format
         data["user"] = config.user
@@ -104,36 +102,47 @@ async def proxy_request(
         headers: Dict[str, str] = {"Content-Type": "application/json"}
 
         # Send transformed request to the target API using aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                config.argo_embedding_url, headers=headers, json=data
-            ) as resp:
+        session: aiohttp.ClientSession = request["session"]
+        async with session.post(
+            config.argo_embedding_url, headers=headers, json=data
+        ) as resp:
+            with timed("body"):
                 response_data: Dict[str, Any] = await resp.json()
-                resp.raise_for_status()
+            resp.raise_for_status()
 
-                if config.verbose:
-                    logger.info(make_bar("[embed] fwd. response"))
-                    logger.info(json.dumps(response_data, indent=4))
-                    logger.info(make_bar())
+            log_payload(request, "[embed] fwd. response", response_data)
 
-                if convert_to_openai:
+            if convert_to_openai:
+                # Large batches of inputs are tokenized off the event loop
+                with timed("tokenize"):
+                    prompt_tokens = await count_tokens_async(
+                        data["prompt"],
+                        data["model"],
+                        config.token_usage_mode(data["model"], request.path),
+                    )
+                record_prompt_tokens(prompt_tokens)
+                with timed("convert"):
                     openai_response = make_it_openai_embeddings_compat(
                         json.dumps(response_data),
                         data["model"],
                         data["prompt"],
+                        prompt_tokens=prompt_tokens,
                     )
                     return web.json_response(
                         openai_response,
                         status=resp.status,
                         content_type="application/json",
                     )
-                else:
+            else:
+                with timed("convert"):
                     return web.json_response(
                         response_data,
                         status=resp.status,
                         content_type="application/json",
                     )
 
+    except web.HTTPRequestEntityTooLarge:
+        raise  # server.client_max_size exceeded, answered with 413
     except ValueError as err:
         return web.json_response(
             {"error": str(err)},
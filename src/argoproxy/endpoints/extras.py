@@ -1,44 +1,24 @@
-from datetime import datetime
-from typing import Any, Dict, Optional
+from http import HTTPStatus
 
-import aiohttp
 from aiohttp import web
 
-from ..constants import ALL_MODELS
+from ..models import get_registry
 
-# Mock data for available models
-MODELS_DATA: Dict[str, Any] = {"object": "list", "data": []}  # type: ignore
 
-# Populate the models data with the combined models
-for model_id, model_name in ALL_MODELS.items():
-    MODELS_DATA["data"].append(
-        {
-            "id": model_id,  # Include the key (e.g., "argo:gpt-4o")
-            "object": "model",
-            "created": int(
-                datetime.now().timestamp()
-            ),  # Use current timestamp for simplicity
-            "owned_by": "system",  # Default ownership
-            "internal_name": model_name,  # Include the value (e.g., "gpt4o")
-        }
-    )
-
-
-def get_models():
+def get_models(request: web.Request) -> web.Response:
     """
     Returns a list of available models in OpenAI-compatible format.
-    """
-    return web.json_response(MODELS_DATA, status=200)
 
-
-async def get_latest_pypi_version() -> Optional[str]:
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://pypi.org/pypi/argo-proxy/json", timeout=5
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return data["info"]["version"]
-    except Exception:
-        return None
+    The body is serialized once with the model registry. Clients sending
+    its ETag back in `If-None-Match` get `304 Not Modified`.
+    """
+    registry = get_registry()
+    headers = {"ETag": registry.etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match.strip() == "*" or registry.etag in (
+        tag.strip() for tag in if_none_match.split(",")
+    ):
+        return web.Response(status=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return web.Response(
+        body=registry.models_body, content_type="application/json", headers=headers
+    )
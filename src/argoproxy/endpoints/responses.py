@@ -1,16 +1,31 @@
-import fnmatch
 import json
 import time
 import uuid
 from http import HTTPStatus
-from typing import Any, Dict, Union
+from typing import Any, Dict, Optional, Union
 
 import aiohttp
 from aiohttp import web
 from loguru import logger
 
 from ..config import ArgoConfig
-from ..constants import CHAT_MODELS
+from ..metrics import (
+    StreamMetrics,
+    record_prompt_tokens,
+    server_timing_comment,
+    set_request_model,
+    timed,
+)
+from ..models import get_registry
+from ..ratelimit import charging_completion, completion_usage_mode
+from ..streaming import (
+    StreamBuffer,
+    StreamRegistry,
+    await_upstream,
+    join_stream,
+    serve_stream,
+    start_producer,
+)
 from ..types import (
     Response,
     ResponseCompletedEvent,
@@ -27,28 +42,16 @@ from ..types import (
     ResponseUsage,
 )
 from ..utils import (
-    calculate_prompt_tokens,
+    StreamStopper,
+    calculate_prompt_tokens_async,
     count_tokens,
-    make_bar,
-    resolve_model_name,
+    log_payload,
     send_off_sse,
 )
-from .chat import send_non_streaming_request
+from .chat import fit_context_window, send_non_streaming_request
 
 DEFAULT_MODEL = "gpt4o"
 
-NO_SYS_MSG_PATTERNS = {
-    "^argo:gpt-o.*$",
-    "^argo:o.*$",
-    "^gpto.*$",
-}
-
-NO_SYS_MSG = [
-    model
-    for model in CHAT_MODELS
-    if any(fnmatch.fnmatch(model, pattern) for pattern in NO_SYS_MSG_PATTERNS)
-]
-
 INCOMPATIBLE_INPUT_FIELDS = {
     "include",
     "metadata",
@@ -60,7 +63,6 @@ INCOMPATIBLE_INPUT_FIELDS = {
     "text",
     "tool_choice",
     "tools",
-    "truncation",
 }
 
 
@@ -69,6 +71,7 @@ def transform_non_streaming_response(
     model_name: str,
     create_timestamp: int,
     prompt_tokens: int,
+    completion_tokens: Optional[int] = None,
     **kwargs,
 ) -> Dict[str, Any]:
     """
@@ -79,6 +82,7 @@ def transform_non_streaming_response(
         model_name: The name of the model that generated the completion.
         create_timestamp: The creation timestamp of the completion.
         prompt_tokens: The number of tokens in the input prompt.
+        completion_tokens: The number of tokens in the response, if already counted.
 
     Returns:
         A dictionary representing the OpenAI-compatible JSON response.
@@ -90,7 +94,8 @@ def transform_non_streaming_response(
             custom_response_dict = custom_response
 
         response_text = custom_response_dict.get("response", "")
-        completion_tokens = count_tokens(response_text, model_name)
+        if completion_tokens is None:
+            completion_tokens = count_tokens(response_text, model_name)
         total_tokens = prompt_tokens + completion_tokens
         usage = ResponseUsage(
             input_tokens=prompt_tokens,
@@ -187,17 +192,16 @@ def prepare_request_data(
     Returns:
         The modified and prepared request data.
     """
-    config: ArgoConfig = request.app["config"]
+    config: ArgoConfig = request["config"]
     # Automatically replace or insert the user
     data["user"] = config.user
 
-    # Remap the model using MODEL_AVAIL
-    if "model" in data:
-        data["model"] = resolve_model_name(
-            data["model"], DEFAULT_MODEL, avail_models=CHAT_MODELS
-        )
-    else:
-        data["model"] = DEFAULT_MODEL
+    # Remap the model using the model registry
+    model = get_registry().resolve(
+        data.get("model", DEFAULT_MODEL), "chat", DEFAULT_MODEL
+    )
+    data["model"] = model.name
+    set_request_model(model.name)
 
     # obtain messages from input
     messages = data.get("input", [])
@@ -214,7 +218,7 @@ def prepare_request_data(
         del data["max_output_tokens"]
 
     # Convert system message to user message for specific models
-    if data["model"] in NO_SYS_MSG:
+    if not model.system_message:
         if "messages" in data:
             for message in data["messages"]:
                 if message["role"] == "system":
@@ -249,38 +253,66 @@ async def send_streaming_request(
         "Accept-Encoding": "identity",
     }
 
-    # Set response headers based on the mode
-    response_headers = {"Content-Type": "text/event-stream"}
-    created_timestamp = int(time.time())
-    prompt_tokens = calculate_prompt_tokens(data, data["model"])
-
-    async with session.post(api_url, headers=headers, json=data) as upstream_resp:
-        if upstream_resp.status != 200:
-            # Read error content from upstream response
-            error_text = await upstream_resp.text()
-            # Return JSON error response to client
-            return web.json_response(
-                {"error": f"Upstream API error: {upstream_resp.status} {error_text}"},
-                status=upstream_resp.status,
-                content_type="application/json",
-            )
+    config: ArgoConfig = request["config"]
+    registry: StreamRegistry = request.app["streams"]
 
-        # Initialize the streaming response
-        response_headers.update(
-            {
-                k: v
-                for k, v in upstream_resp.headers.items()
-                if k.lower()
-                not in ("Content-Type", "content-encoding", "transfer-encoding")
-            }
+    heartbeat = config.heartbeat_interval(data["model"])
+    # Identical deterministic requests share a single upstream stream
+    key = registry.coalescing_key(request.path, data)
+    live, response = await join_stream(request, registry, key, heartbeat)
+    if live is not None:
+        return await serve_stream(request, registry, live, response=response)
+
+    try:
+        # Set response headers based on the mode
+        response_headers = {"Content-Type": "text/event-stream"}
+        created_timestamp = int(time.time())
+        usage_mode = config.token_usage_mode(data["model"], request.path)
+        with timed("tokenize"):
+            prompt_tokens = await calculate_prompt_tokens_async(
+                data, data["model"], usage_mode
+            )
+        record_prompt_tokens(prompt_tokens)
+
+        upstream_resp, response = await await_upstream(
+            request,
+            session.post(api_url, headers=headers, json=data),
+            response_headers,
+            heartbeat,
+            response=response,
         )
-        response = web.StreamResponse(
+    except BaseException:
+        registry.abandon(key)
+        raise
+    if upstream_resp is None:
+        # Failed after heartbeats started; the error was sent in the stream
+        registry.abandon(key)
+        return response
+
+    if upstream_resp.status != 200:
+        registry.abandon(key)
+        # Read error content from upstream response
+        error_text = await upstream_resp.text()
+        upstream_resp.release()
+        # Return JSON error response to client
+        return web.json_response(
+            {"error": f"Upstream API error: {upstream_resp.status} {error_text}"},
             status=upstream_resp.status,
-            headers=response_headers,
+            content_type="application/json",
         )
-        response.enable_chunked_encoding()
-        await response.prepare(request)
 
+    stream_buffer = StreamBuffer(config.stream_spill_threshold)
+
+    # Enforce max_output_tokens even if the upstream does not
+    stopper = StreamStopper(
+        data["model"],
+        stop=data.get("stop"),
+        max_tokens=data.get("max_tokens"),
+        count_usage=True,
+        usage_mode=completion_usage_mode(usage_mode),
+    )
+
+    async def pump_upstream() -> None:
         # =======================================
         # Start event flow with ResponseCreatedEvent
         sequence_number = 0
@@ -297,7 +329,7 @@ async def send_streaming_request(
             response=onset_response,
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, created_event.model_dump())
+        await send_off_sse(stream_buffer, created_event.model_dump())
 
         # =======================================
         # ResponseInProgressEvent, start streaming the response
@@ -306,7 +338,7 @@ async def send_streaming_request(
             response=onset_response,
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, in_progress_event.model_dump())
+        await send_off_sse(stream_buffer, in_progress_event.model_dump())
 
         # =======================================
         # ResponseOutputItemAddedEvent, add the output item
@@ -321,7 +353,7 @@ async def send_streaming_request(
             output_index=0,
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, output_item.model_dump())
+        await send_off_sse(stream_buffer, output_item.model_dump())
 
         # =======================================
         # ResponseContentPartAddedEvent, add the content part
@@ -334,14 +366,28 @@ async def send_streaming_request(
             part=ResponseOutputText(text=""),
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, content_part.model_dump())
+        await send_off_sse(stream_buffer, content_part.model_dump())
 
         # =======================================
         # ResponseTextDeltaEvent, stream the response chunk by chunk
         cumulated_response = ""
-        async for chunk in upstream_resp.content.iter_any():
+
+        timing = StreamMetrics(api_url, data["model"])
+
+        async def iter_text():
+            async for chunk in upstream_resp.content.iter_any():
+                text = chunk.decode()
+                timing.chunk(text)
+                yield stopper.feed(text)
+                if stopper.finish_reason:
+                    # Returning early closes the upstream connection
+                    return
+            yield stopper.flush()
+
+        async for chunk_text in iter_text():
+            if not chunk_text:
+                continue
             sequence_number += 1
-            chunk_text = chunk.decode()
             cumulated_response += chunk_text  # for ResponseTextDoneEvent
 
             # Convert the chunk to OpenAI-compatible JSON
@@ -353,7 +399,10 @@ async def send_streaming_request(
                 id=output_msg.id,
             )
             # Wrap the JSON in SSE format
-            await send_off_sse(response, text_delta)
+            await send_off_sse(stream_buffer, text_delta)
+            timing.converted()
+
+        timing.finish(stopper.completion_tokens)
 
         # =======================================
         # ResponseTextDoneEvent, signal the end of the text stream
@@ -365,7 +414,7 @@ async def send_streaming_request(
             sequence_number=sequence_number,
             text=cumulated_response,  # Use the cumulated response tex
         )
-        await send_off_sse(response, text_done.model_dump())
+        await send_off_sse(stream_buffer, text_done.model_dump())
 
         # =======================================
         # ResponseContentPartDoneEvent, signal the end of the content part
@@ -378,27 +427,28 @@ async def send_streaming_request(
             part=output_text,
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, content_part_done.model_dump())
+        await send_off_sse(stream_buffer, content_part_done.model_dump())
 
         # =======================================
         # ResponseOutputItemDoneEvent, signal the end of the output item
         sequence_number += 1
         output_msg.content = [output_text]
-        output_msg.status = "completed"
+        status = "incomplete" if stopper.finish_reason == "length" else "completed"
+        output_msg.status = status
 
         output_item_done = ResponseOutputItemDoneEvent(
             item=output_msg,
             output_index=output_item.output_index,
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, output_item_done.model_dump())
+        await send_off_sse(stream_buffer, output_item_done.model_dump())
 
         # =======================================
         # ResponseCompletedEvent, signal the end of the response
         sequence_number += 1
         onset_response.output.append(output_msg)
-        onset_response.status = "completed"
-        output_tokens = count_tokens(cumulated_response, data["model"])
+        onset_response.status = status
+        output_tokens = stopper.completion_tokens  # counted while streaming
         onset_response.usage = ResponseUsage(
             input_tokens=prompt_tokens,
             output_tokens=output_tokens,
@@ -408,14 +458,38 @@ async def send_streaming_request(
             response=onset_response,
             sequence_number=sequence_number,
         )
-        await send_off_sse(response, completed_event.model_dump())
-
-        # =======================================
-        # Ensure response is properly closed
-
-        await response.write_eof()
-
-        return response
+        await send_off_sse(stream_buffer, completed_event.model_dump())
+
+        if comment := server_timing_comment():
+            await stream_buffer.write(comment)
+
+    # Drain upstream at full speed; the client is fed from the buffer.
+    # Completion tokens count against the client's rate limit once known.
+    producer = start_producer(
+        charging_completion(pump_upstream(), lambda: stopper.completion_tokens),
+        upstream_resp,
+        stream_buffer,
+    )
+
+    # Initialize the streaming response
+    response_headers.update(
+        {
+            k: v
+            for k, v in upstream_resp.headers.items()
+            if k.lower()
+            not in ("Content-Type", "content-encoding", "transfer-encoding")
+        }
+    )
+    # SSE streams stay resumable through Last-Event-ID after a disconnect
+    live = registry.open(
+        stream_buffer,
+        producer,
+        upstream_resp.status,
+        response_headers,
+        key=key,
+        heartbeat=heartbeat,
+    )
+    return await serve_stream(request, registry, live, response=response)
 
 
 async def proxy_request(
@@ -430,45 +504,49 @@ async def proxy_request(
     Returns:
         A web.Response or web.StreamResponse with the final response from the upstream API.
     """
-    config: ArgoConfig = request.app["config"]
+    config: ArgoConfig = request["config"]
 
     try:
         # Retrieve the incoming JSON data from request if input_data is not provided
 
-        data = await request.json()
+        with timed("parse"):
+            data = await request.json()
         stream = data.get("stream", False)
 
         if not data:
             raise ValueError("Invalid input. Expected JSON data.")
-        if config.verbose:
-            logger.info(make_bar("[response] input"))
-            logger.info(json.dumps(data, indent=4))
-            logger.info(make_bar())
+        log_payload(request, "[response] input", data)
 
         # Prepare the request data
-        data = prepare_request_data(data, request)
+        with timed("prepare"):
+            data = prepare_request_data(data, request)
+        with timed("tokenize"):
+            await fit_context_window(data, request)
 
         # Determine the API URL based on whether streaming is enabled
         api_url = config.argo_stream_url if stream else config.argo_url
 
         # Forward the modified request to the actual API using aiohttp
-        async with aiohttp.ClientSession() as session:
-            if stream:
-                return await send_streaming_request(
-                    session,
-                    api_url,
-                    data,
-                    request,
-                )
-            else:
-                return await send_non_streaming_request(
-                    session,
-                    api_url,
-                    data,
-                    convert_to_openai=True,
-                    openai_compat_fn=transform_non_streaming_response,
-                )
+        session: aiohttp.ClientSession = request["session"]
+        if stream:
+            return await send_streaming_request(
+                session,
+                api_url,
+                data,
+                request,
+            )
+        else:
+            return await send_non_streaming_request(
+                session,
+                api_url,
+                data,
+                convert_to_openai=True,
+                openai_compat_fn=transform_non_streaming_response,
+                usage_mode=config.token_usage_mode(data["model"], request.path),
+            )
 
+    except web.HTTPRequestEntityTooLarge:
+        raise  # server.client_max_size exceeded, answered with 413
     except ValueError as err:
         return web.json_response(
             {"error": str(err)},
@@ -0,0 +1,45 @@
+from http import HTTPStatus
+from typing import Union
+
+from aiohttp import web
+
+from ..streaming import StreamRegistry, parse_last_event_id, serve_stream
+
+
+async def resume_request(
+    request: web.Request,
+) -> Union[web.Response, web.StreamResponse]:
+    """Replays a buffered stream from the event after `Last-Event-ID`.
+
+    Finished streams are replayed from their buffer; live ones continue with
+    the remaining events as they arrive, without a new upstream call.
+
+    Args:
+        request: The client's web request object.
+
+    Returns:
+        A web.StreamResponse with the remaining SSE events, or a JSON error.
+    """
+    registry: StreamRegistry = request.app["streams"]
+    stream_id = request.match_info["stream_id"]
+
+    live = registry.get(stream_id)
+    if live is None:
+        return web.json_response(
+            {"error": f"Stream {stream_id} not found or expired."},
+            status=HTTPStatus.NOT_FOUND,
+            content_type="application/json",
+        )
+
+    try:
+        start = parse_last_event_id(
+            request.headers.get("Last-Event-ID") or request.query.get("last_event_id")
+        )
+    except ValueError as err:
+        return web.json_response(
+            {"error": str(err)},
+            status=HTTPStatus.BAD_REQUEST,
+            content_type="application/json",
+        )
+
+    return await serve_stream(request, registry, live, start)
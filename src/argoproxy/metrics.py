@@ -0,0 +1,723 @@
+import asyncio
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+
+from .utils import _estimate, get_tiktoken_encoding_model
+
+# Upper bounds in seconds of the latency histogram buckets, from a cached
+# /v1/models answer up to a long completion stream
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+# Upper bounds in seconds of the buckets of short waits: gaps between stream
+# chunks, DNS lookups and connects
+SHORT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Upper bounds of the buckets of stream output rates, in tokens per second
+RATE_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Request header asking for every phase in Server-Timing, not the summary
+TIMING_DETAIL_HEADER = "X-Timing-Detail"
+# Phases spent waiting for the upstream; the rest of a request is the proxy's
+UPSTREAM_PHASES = ("ttfb", "body")
+
+
+class Counter:
+    """Value of a counter for one combination of label values."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value: Union[int, float] = 0
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        self.value += amount
+
+
+class Gauge(Counter):
+    """Value of a gauge for one combination of label values."""
+
+    __slots__ = ()
+
+    def dec(self, amount: Union[int, float] = 1) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    """
+    Observations of a histogram for one combination of label values, kept
+    per bucket and summed up into cumulative counts only when rendered.
+    """
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+Child = Union[Counter, Gauge, Histogram]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Family:
+    """
+    A metric and its children, one per combination of label values.
+
+    `labels` creates a child on first use and returns the same one after,
+    so callers bind the children they need once and update them directly.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        documentation: str,
+        labelnames: Tuple[str, ...],
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.kind = kind  # "counter", "gauge" or "histogram"
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._children: Dict[Tuple[str, ...], Child] = {}
+
+    def labels(self, *values: str) -> Child:
+        child = self._children.get(values)
+        if child is None:
+            if self.kind == "histogram":
+                child = Histogram(self.buckets)
+            elif self.kind == "gauge":
+                child = Gauge()
+            else:
+                child = Counter()
+            self._children[values] = child
+        return child
+
+    def render(self) -> Iterator[str]:
+        """Lines of the family in the Prometheus text format."""
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self._children.items():
+            labels = ",".join(
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.labelnames, values)
+            )
+            if not isinstance(child, Histogram):
+                yield f"{self.name}{{{labels}}} {child.value}"
+                continue
+            sep = "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}'
+            cumulative += child.counts[-1]
+            yield f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {cumulative}'
+            yield f"{self.name}_sum{{{labels}}} {child.sum}"
+            yield f"{self.name}_count{{{labels}}} {cumulative}"
+
+
+class ModelMetrics:
+    """Children of the metrics of one route and model."""
+
+    __slots__ = (
+        "route",
+        "model",
+        "_requests",
+        "_statuses",
+        "duration",
+        "upstream_duration",
+        "prompt_tokens",
+        "completion_tokens",
+    )
+
+    def __init__(self, metrics: "ProxyMetrics", route: str, model: str):
+        self.route = route
+        self.model = model
+        self._requests = metrics.requests
+        self._statuses: Dict[int, Counter] = {}
+        self.duration = metrics.request_duration.labels(route, model)
+        self.upstream_duration = metrics.upstream_duration.labels(route, model)
+        self.prompt_tokens = metrics.prompt_tokens.labels(route, model)
+        self.completion_tokens = metrics.completion_tokens.labels(route, model)
+
+    def status(self, status: int) -> Counter:
+        counter = self._statuses.get(status)
+        if counter is None:
+            counter = self._statuses[status] = self._requests.labels(
+                self.route, self.model, str(status)
+            )
+        return counter
+
+
+class RouteMetrics:
+    """Children of the metrics of one route, and of its models."""
+
+    __slots__ = ("_metrics", "route", "_models", "in_flight", "bytes_in", "bytes_out")
+
+    def __init__(self, metrics: "ProxyMetrics", route: str):
+        self._metrics = metrics
+        self.route = route
+        self._models: Dict[str, ModelMetrics] = {}
+        self.in_flight = metrics.in_flight.labels(route)
+        self.bytes_in = metrics.bytes_in.labels(route)
+        self.bytes_out = metrics.bytes_out.labels(route)
+
+    def model(self, model: str) -> ModelMetrics:
+        children = self._models.get(model)
+        if children is None:
+            children = self._models[model] = ModelMetrics(
+                self._metrics, self.route, model
+            )
+        return children
+
+
+class UpstreamMetrics:
+    """Children of the metrics of one upstream host."""
+
+    __slots__ = (
+        "dns",
+        "pool_wait",
+        "connect",
+        "new_connections",
+        "reused_connections",
+        "send",
+        "first_byte",
+    )
+
+    def __init__(self, metrics: "ProxyMetrics", upstream: str):
+        self.dns = metrics.upstream_dns.labels(upstream)
+        self.pool_wait = metrics.upstream_pool_wait.labels(upstream)
+        self.connect = metrics.upstream_connect.labels(upstream)
+        self.new_connections = metrics.upstream_connections.labels(upstream, "new")
+        self.reused_connections = metrics.upstream_connections.labels(
+            upstream, "reused"
+        )
+        self.send = metrics.upstream_send.labels(upstream)
+        self.first_byte = metrics.upstream_first_byte.labels(upstream)
+
+
+class ProxyMetrics:
+    """
+    The metrics of the proxy, exposed on /metrics. Each worker process has
+    its own, see `run_workers`.
+    """
+
+    def __init__(self):
+        self.families: List[Family] = []
+        route_model = ("route", "model")
+        self.requests = self._add(
+            "argoproxy_requests_total",
+            "counter",
+            "Requests handled, by route, model and status code.",
+            ("route", "model", "status"),
+        )
+        self.request_duration = self._add(
+            "argoproxy_request_duration_seconds",
+            "histogram",
+            "Time from receiving a request until its response or stream ended.",
+            route_model,
+        )
+        self.upstream_duration = self._add(
+            "argoproxy_upstream_duration_seconds",
+            "histogram",
+            "Time from sending a request upstream until its response headers.",
+            route_model,
+        )
+        self.in_flight = self._add(
+            "argoproxy_requests_in_flight",
+            "gauge",
+            "Requests being handled.",
+            ("route",),
+        )
+        self.prompt_tokens = self._add(
+            "argoproxy_prompt_tokens_total",
+            "counter",
+            "Prompt tokens counted, see token_usage_mode.",
+            route_model,
+        )
+        self.completion_tokens = self._add(
+            "argoproxy_completion_tokens_total",
+            "counter",
+            "Completion tokens counted, see token_usage_mode.",
+            route_model,
+        )
+        self.bytes_in = self._add(
+            "argoproxy_request_bytes_total",
+            "counter",
+            "Bytes of request bodies received.",
+            ("route",),
+        )
+        self.bytes_out = self._add(
+            "argoproxy_response_bytes_total",
+            "counter",
+            "Bytes of response bodies sent.",
+            ("route",),
+        )
+        model_upstream = ("model", "upstream")
+        self.stream_first_chunk = self._add(
+            "argoproxy_stream_first_chunk_seconds",
+            "histogram",
+            "Time from receiving a streaming request until its first upstream chunk.",
+            model_upstream,
+        )
+        self.stream_chunk_gap = self._add(
+            "argoproxy_stream_chunk_gap_seconds",
+            "histogram",
+            "Time between consecutive chunks of upstream streams.",
+            model_upstream,
+            SHORT_BUCKETS,
+        )
+        self.stream_tokens_per_second = self._add(
+            "argoproxy_stream_tokens_per_second",
+            "histogram",
+            "Output tokens per second of upstream streams, from their first to last chunk.",
+            model_upstream,
+            RATE_BUCKETS,
+        )
+        self.upstream_dns = self._add(
+            "argoproxy_upstream_dns_seconds",
+            "histogram",
+            "Time resolving upstream hosts, for lookups not served from the cache.",
+            ("upstream",),
+            SHORT_BUCKETS,
+        )
+        self.upstream_pool_wait = self._add(
+            "argoproxy_upstream_pool_wait_seconds",
+            "histogram",
+            "Time waiting for a free upstream connection when the pool is full.",
+            ("upstream",),
+            SHORT_BUCKETS,
+        )
+        self.upstream_connect = self._add(
+            "argoproxy_upstream_connect_seconds",
+            "histogram",
+            "Time opening new upstream connections, TCP and TLS, DNS excluded.",
+            ("upstream",),
+            SHORT_BUCKETS,
+        )
+        self.upstream_connections = self._add(
+            "argoproxy_upstream_connections_total",
+            "counter",
+            "Upstream requests by whether they opened a new connection or reused one.",
+            ("upstream", "connection"),
+        )
+        self.upstream_send = self._add(
+            "argoproxy_upstream_send_seconds",
+            "histogram",
+            "Time writing requests to upstream connections.",
+            ("upstream",),
+            SHORT_BUCKETS,
+        )
+        self.upstream_first_byte = self._add(
+            "argoproxy_upstream_first_byte_seconds",
+            "histogram",
+            "Time from a request sent upstream until its response headers.",
+            ("upstream",),
+        )
+        self._routes: Dict[str, RouteMetrics] = {}
+        self._upstreams: Dict[str, UpstreamMetrics] = {}
+
+    def _add(
+        self, name, kind, documentation, labelnames, buckets=LATENCY_BUCKETS
+    ) -> Family:
+        family = Family(name, kind, documentation, labelnames, buckets)
+        self.families.append(family)
+        return family
+
+    def route(self, route: str) -> RouteMetrics:
+        children = self._routes.get(route)
+        if children is None:
+            children = self._routes[route] = RouteMetrics(self, route)
+        return children
+
+    def upstream(self, upstream: str) -> UpstreamMetrics:
+        children = self._upstreams.get(upstream)
+        if children is None:
+            children = self._upstreams[upstream] = UpstreamMetrics(self, upstream)
+        return children
+
+    def render(self) -> bytes:
+        """All metrics in the Prometheus text format."""
+        lines = [line for family in self.families for line in family.render()]
+        lines.append("")
+        return "\n".join(lines).encode()
+
+
+class RequestMetrics:
+    """
+    Metrics of the request being handled, and of the streams it starts,
+    with the time spent in each phase of it, e.g. "parse" or "tokenize".
+    """
+
+    __slots__ = ("metrics", "route", "model", "start", "phases", "detailed")
+
+    def __init__(self, metrics: ProxyMetrics, route: str, detailed: bool = False):
+        self.metrics = metrics
+        self.route = metrics.route(route)
+        self.model = self.route.model("")  # until the handler resolves it
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.detailed = detailed  # every phase in server_timing
+
+    def add_phase(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def upstream_seconds(self) -> float:
+        """Time spent so far waiting for the upstream."""
+        return sum(self.phases.get(phase, 0.0) for phase in UPSTREAM_PHASES)
+
+    def server_timing(self) -> str:
+        """
+        The time spent so far as a Server-Timing header value, in ms: every
+        phase if `detailed`, otherwise split into the proxy's own time and
+        the time spent waiting for the upstream.
+        """
+        total = time.perf_counter() - self.start
+        if self.detailed:
+            entries = [*self.phases.items(), ("total", total)]
+        else:
+            upstream = self.upstream_seconds()
+            entries = [("proxy", total - upstream), ("upstream", upstream)]
+            entries.append(("total", total))
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in entries
+        )
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    "request_metrics", default=None
+)
+
+
+def set_request_model(model: str) -> None:
+    """Labels the metrics of the current request with its resolved model."""
+    current = _current.get()
+    if current is not None:
+        current.model = current.route.model(model)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Adds the time spent in the block to `phase` of the current request."""
+    current = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if current is not None:
+            current.add_phase(phase, time.perf_counter() - start)
+
+
+def server_timing_comment() -> bytes:
+    """
+    The Server-Timing of the current request as a final SSE comment line.
+    It has no blank line after it, so it does not end an event.
+    """
+    current = _current.get()
+    if current is None:
+        return b""
+    return f": server-timing {current.server_timing()}\n".encode()
+
+
+def record_prompt_tokens(tokens: int) -> None:
+    current = _current.get()
+    if current is not None:
+        current.model.prompt_tokens.inc(tokens)
+
+
+def record_completion_tokens(tokens: int) -> None:
+    current = _current.get()
+    if current is not None:
+        current.model.completion_tokens.inc(tokens)
+
+
+def _upstream_of(url: str) -> str:
+    """Host and explicit port of `url`, leaving out any credentials."""
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    return f"{host}:{parts.port}" if parts.port else host
+
+
+def _route_of(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    # Unmatched paths are not labelled by path, which clients choose freely
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """
+    Counts each request by route, model and status, and times it. The
+    children of its route are looked up once, so a request only updates
+    values. Responses get the time spent in each phase of the request in a
+    Server-Timing header.
+    """
+    current = RequestMetrics(
+        request.app["metrics"],
+        _route_of(request),
+        detailed=request.headers.get(TIMING_DETAIL_HEADER, "").lower()
+        in ("1", "true", "yes"),
+    )
+    route = current.route
+    token = _current.set(current)
+    request["request_metrics"] = current  # for the JSON access log
+    route.in_flight.inc()
+    route.bytes_in.inc(request.content_length or 0)
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        if not response.prepared:
+            response.headers["Server-Timing"] = current.server_timing()
+        return response
+    except web.HTTPException as err:
+        status = err.status
+        raise
+    except asyncio.CancelledError:
+        status = 499  # the client went away
+        raise
+    finally:
+        _current.reset(token)
+        model = current.model
+        model.duration.observe(time.perf_counter() - current.start)
+        model.status(status).inc()
+        route.in_flight.dec()
+        if response is not None:
+            route.bytes_out.inc(
+                response.body_length
+                if response.prepared
+                else (response.content_length or 0)
+            )
+
+
+class StreamMetrics:
+    """
+    Times the chunks of an upstream stream started by the current request:
+    the time to the first chunk since the request arrived, the gaps between
+    chunks, and the output tokens per second. Call `chunk` as each chunk
+    arrives, `converted` once it was converted and sent on, and `finish`
+    once the stream ended; the request gets the "body" and "convert"
+    phases.
+
+    Args:
+        api_url: URL of the upstream, whose host labels the metrics.
+        model: Argo name of the model streaming.
+    """
+
+    __slots__ = (
+        "_request",
+        "_first_chunk",
+        "_gap",
+        "_rate",
+        "_start",
+        "_opened",
+        "_first",
+        "_last",
+        "_convert",
+        "_encoding",
+        "_estimated",
+    )
+
+    def __init__(self, api_url: str, model: str):
+        self._request = current = _current.get()
+        if current is not None:
+            metrics = current.metrics
+            upstream = _upstream_of(api_url)
+            self._first_chunk = metrics.stream_first_chunk.labels(model, upstream)
+            self._gap = metrics.stream_chunk_gap.labels(model, upstream)
+            self._rate = metrics.stream_tokens_per_second.labels(model, upstream)
+            self._start = current.start
+        else:
+            # Outside a request: observed, but not exposed
+            self._first_chunk = Histogram(LATENCY_BUCKETS)
+            self._gap = Histogram(SHORT_BUCKETS)
+            self._rate = Histogram(RATE_BUCKETS)
+            self._start = time.perf_counter()
+        self._opened = time.perf_counter()
+        self._first: Optional[float] = None
+        self._last = 0.0
+        self._convert = 0.0
+        self._encoding = get_tiktoken_encoding_model(model)
+        self._estimated = 0.0
+
+    def chunk(self, text: str = "") -> None:
+        now = time.perf_counter()
+        if self._first is None:
+            self._first = now
+            self._first_chunk.observe(now - self._start)
+        else:
+            self._gap.observe(now - self._last)
+        self._last = now
+        if text:
+            # Estimated as it goes, for streams that do not count tokens
+            self._estimated += _estimate(text, self._encoding)
+
+    def converted(self) -> None:
+        self._convert += time.perf_counter() - self._last
+
+    def finish(self, tokens: int = 0) -> None:
+        """
+        Observes the output rate of the stream, of `tokens` if counted,
+        otherwise of the estimated tokens of the chunk texts.
+        """
+        if self._request is not None:
+            self._request.add_phase("body", time.perf_counter() - self._opened)
+            self._request.add_phase("convert", self._convert)
+        if self._first is None or self._last <= self._first:
+            return
+        tokens = tokens or math.ceil(self._estimated)
+        self._rate.observe(tokens / (self._last - self._first))
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    """
+    Client tracing timing each upstream request into the metrics of its
+    upstream and of the request that sent it, and into these phases of it:
+
+    - "queue": waiting for a free connection when the pool is full
+    - "dns": resolving the upstream host, unless it was cached
+    - "connect": opening a new connection, TCP and TLS handshakes together
+      as aiohttp does not trace them apart, after its DNS lookup
+    - "send": writing the request on the connection
+    - "wait": from the request sent until the upstream's response headers
+    - "ttfb": the whole time until the response headers
+    """
+
+    async def on_request_start(
+        session: aiohttp.ClientSession,
+        context: SimpleNamespace,
+        params: aiohttp.TraceRequestStartParams,
+    ) -> None:
+        context.metrics = current = _current.get()
+        if current is not None:
+            context.upstream = current.metrics.upstream(_upstream_of(str(params.url)))
+            context.start = context.ready = context.sent = time.perf_counter()
+            context.dns = 0.0
+
+    async def on_connection_queued_start(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        context.queued = time.perf_counter()
+
+    async def on_connection_queued_end(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        if context.metrics is not None:
+            elapsed = time.perf_counter() - context.queued
+            context.upstream.pool_wait.observe(elapsed)
+            context.metrics.add_phase("queue", elapsed)
+
+    async def on_dns_resolvehost_start(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        context.resolving = time.perf_counter()
+
+    async def on_dns_resolvehost_end(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        if context.metrics is not None:
+            elapsed = time.perf_counter() - context.resolving
+            context.dns += elapsed
+            context.upstream.dns.observe(elapsed)
+            context.metrics.add_phase("dns", elapsed)
+
+    async def on_connection_create_start(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        context.connecting = time.perf_counter()
+
+    async def on_connection_create_end(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        if context.metrics is not None:
+            context.ready = time.perf_counter()
+            # The DNS lookup happens within the connection creation
+            elapsed = context.ready - context.connecting - context.dns
+            context.upstream.connect.observe(elapsed)
+            context.upstream.new_connections.inc()
+            context.metrics.add_phase("connect", elapsed)
+
+    async def on_connection_reuseconn(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        if context.metrics is not None:
+            context.ready = time.perf_counter()
+            context.upstream.reused_connections.inc()
+
+    async def on_request_sent(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        # Once for the headers, then for each chunk of the body
+        context.sent = time.perf_counter()
+
+    async def on_request_end(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        current = context.metrics
+        if current is None:
+            return
+        now = time.perf_counter()
+        send, wait = context.sent - context.ready, now - context.sent
+        context.upstream.send.observe(send)
+        context.upstream.first_byte.observe(wait)
+        current.model.upstream_duration.observe(now - context.start)
+        current.add_phase("send", send)
+        current.add_phase("wait", wait)
+        current.add_phase("ttfb", now - context.start)
+
+    async def on_request_exception(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params
+    ) -> None:
+        if context.metrics is not None:
+            elapsed = time.perf_counter() - context.start
+            context.metrics.model.upstream_duration.observe(elapsed)
+            context.metrics.add_phase("ttfb", elapsed)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_connection_queued_start.append(on_connection_queued_start)
+    config.on_connection_queued_end.append(on_connection_queued_end)
+    config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    config.on_connection_create_start.append(on_connection_create_start)
+    config.on_connection_create_end.append(on_connection_create_end)
+    config.on_connection_reuseconn.append(on_connection_reuseconn)
+    config.on_request_headers_sent.append(on_request_sent)
+    config.on_request_chunk_sent.append(on_request_sent)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
+
+import tiktoken
+import yaml  # type: ignore
+from loguru import logger
+
+from .constants import (
+    _CHAT_MODELS,
+    _EMBED_MODELS,
+    MODEL_CONTEXT_LENGTHS,
+    NO_SYSTEM_MESSAGE_PREFIXES,
+    TIKTOKEN_ENCODING_PREFIX_MAPPING,
+)
+
+# Encoding of models matching no prefix of TIKTOKEN_ENCODING_PREFIX_MAPPING
+DEFAULT_ENCODING = "cl100k_base"
+# The last model catalog read, used at startup until it is read again
+CATALOG_CACHE_PATH = os.path.expanduser("~/.cache/argoproxy/model_catalog.json")
+# Seconds to wait for a model catalog URL
+CATALOG_TIMEOUT = 10.0
+
+
+def encoding_for(model: str) -> str:
+    """tiktoken encoding of the Argo model named `model`, by its name prefix."""
+    for prefix, encoding in TIKTOKEN_ENCODING_PREFIX_MAPPING.items():
+        if model.startswith(prefix):
+            return encoding
+    return DEFAULT_ENCODING
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    """What the proxy needs to know about a model, shared by its aliases."""
+
+    # Argo's name of the model, e.g. "gpt4o"
+    name: str
+    # "chat" or "embed"
+    kind: str
+    # Whether system messages are accepted, or must be sent as user messages
+    system_message: bool
+    # tiktoken encoding used to count its tokens
+    encoding: str
+    # Context window in tokens, None if unknown
+    context_length: Optional[int]
+
+
+class ModelRegistry:
+    """
+    Index of the models, built once, resolving any alias or Argo name of a
+    model to its `ModelInfo` with a single dict lookup.
+
+    Args:
+        chat: Argo names of the chat models mapped to their alias or aliases,
+            as in `constants._CHAT_MODELS`.
+        embed: The same for the embedding models.
+        context_lengths: Context window of the models by Argo name,
+            `constants.MODEL_CONTEXT_LENGTHS` if None.
+        encodings: tiktoken encoding of the models by Argo name, for those
+            not to be found from their name prefix, see `encoding_for`.
+    """
+
+    def __init__(
+        self,
+        chat: Dict[str, Union[str, List[str]]],
+        embed: Dict[str, Union[str, List[str]]],
+        context_lengths: Optional[Dict[str, int]] = None,
+        encodings: Optional[Dict[str, str]] = None,
+    ):
+        if context_lengths is None:
+            context_lengths = MODEL_CONTEXT_LENGTHS
+        encodings = encodings or {}
+        self._index: Dict[str, ModelInfo] = {}
+        self._aliases: Dict[str, ModelInfo] = {}
+        for kind, models in (("chat", chat), ("embed", embed)):
+            for name, aliases in models.items():
+                info = ModelInfo(
+                    name=name,
+                    kind=kind,
+                    system_message=not (
+                        kind == "chat" and name.startswith(NO_SYSTEM_MESSAGE_PREFIXES)
+                    ),
+                    encoding=encodings.get(name) or encoding_for(name),
+                    context_length=context_lengths.get(name),
+                )
+                self._index[name] = info
+                for alias in [aliases] if isinstance(aliases, str) else aliases:
+                    self._aliases[alias] = info
+        self._index.update(self._aliases)
+
+        created = int(time.time())
+        self.models_body = json.dumps(
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "id": alias,  # e.g. "argo:gpt-4o"
+                        "object": "model",
+                        "created": created,
+                        "owned_by": "system",
+                        "internal_name": info.name,  # e.g. "gpt4o"
+                    }
+                    for alias, info in self._aliases.items()
+                ],
+            }
+        ).encode()
+        # Weak, as `created` differs between workers; the list does not
+        digest = hashlib.sha256(json.dumps(sorted(self.aliases().items())).encode())
+        self.etag = f'W/"{digest.hexdigest()[:32]}"'
+
+    def get(self, model: str) -> Optional[ModelInfo]:
+        """The model named `model`, by alias or Argo name, None if unknown."""
+        return self._index.get(model)
+
+    def canonical(self, model: str) -> str:
+        """Argo name of `model`, or `model` itself if unknown."""
+        info = self._index.get(model)
+        return info.name if info is not None else model
+
+    def resolve(self, model: str, kind: str, default: str) -> ModelInfo:
+        """
+        The `kind` model named `model`, or the `default` one if `model` is
+        unknown or of another kind.
+        """
+        info = self._index.get(model)
+        if info is None or info.kind != kind:
+            return self._index[default]
+        return info
+
+    def aliases(self) -> Dict[str, str]:
+        """Every alias mapped to its Argo name."""
+        return {alias: info.name for alias, info in self._aliases.items()}
+
+
+def _alias_list(aliases: Any) -> List[str]:
+    if isinstance(aliases, str):
+        return [aliases]
+    if isinstance(aliases, list) and all(isinstance(alias, str) for alias in aliases):
+        return aliases
+    raise ValueError(
+        f"Model aliases must be a string or a list of strings: {aliases!r}"
+    )
+
+
+def _merge_models(
+    builtin: Dict[str, Union[str, List[str]]], extra: Any
+) -> Dict[str, List[str]]:
+    if not isinstance(extra, dict):
+        raise ValueError("Catalog models must map Argo model names to aliases")
+    merged = {name: list(_alias_list(aliases)) for name, aliases in builtin.items()}
+    for name, aliases in extra.items():
+        known = merged.setdefault(str(name), [])
+        known.extend(alias for alias in _alias_list(aliases) if alias not in known)
+    return merged
+
+
+def build_registry(catalog: Optional[Dict[str, Any]] = None) -> ModelRegistry:
+    """
+    Builds the registry of the built-in models, merged with those of a
+    model catalog of the form::
+
+        {"chat": {"gpt41": ["argo:gpt-4.1"]}, "embed": {...},
+         "context_lengths": {"gpt41": 1047576},
+         "encodings": {"gpt41": "o200k_base"}}
+
+    Catalog models add to the built-in ones, and their aliases to those of
+    built-in models of the same Argo name.
+
+    Raises:
+        ValueError: If the catalog is malformed.
+    """
+    catalog = catalog or {}
+    if not isinstance(catalog, dict):
+        raise ValueError("The model catalog must be a mapping")
+    context_lengths = catalog.get("context_lengths", {})
+    if not isinstance(context_lengths, dict) or not all(
+        isinstance(length, int) for length in context_lengths.values()
+    ):
+        raise ValueError("Catalog context_lengths must map model names to integers")
+    encodings = catalog.get("encodings", {})
+    if not isinstance(encodings, dict) or not all(
+        encoding in tiktoken.list_encoding_names() for encoding in encodings.values()
+    ):
+        raise ValueError("Catalog encodings must map model names to tiktoken encodings")
+    return ModelRegistry(
+        _merge_models(_CHAT_MODELS, catalog.get("chat", {})),
+        _merge_models(_EMBED_MODELS, catalog.get("embed", {})),
+        {**MODEL_CONTEXT_LENGTHS, **context_lengths},
+        encodings,
+    )
+
+
+async def read_catalog(source: str) -> Dict[str, Any]:
+    """
+    Reads the model catalog from `source`, an http(s) URL serving JSON or
+    the path of a JSON or YAML file.
+    """
+    if source.startswith(("http://", "https://")):
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=CATALOG_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(source) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    def read_file() -> Dict[str, Any]:
+        with open(source) as f:
+            return yaml.safe_load(f)
+
+    return await asyncio.to_thread(read_file)
+
+
+def load_cached_catalog(source: str) -> Optional[Dict[str, Any]]:
+    """The catalog last read from `source`, None if there is none."""
+    try:
+        with open(CATALOG_CACHE_PATH) as f:
+            cached = json.load(f)
+        if cached["source"] == source:
+            return cached["catalog"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_cached_catalog(source: str, catalog: Dict[str, Any]) -> None:
+    """Caches the catalog read from `source`, replacing the file atomically."""
+    try:
+        os.makedirs(os.path.dirname(CATALOG_CACHE_PATH), exist_ok=True)
+        temp_path = f"{CATALOG_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"source": source, "catalog": catalog}, f)
+        os.replace(temp_path, CATALOG_CACHE_PATH)
+    except OSError as err:
+        logger.debug(f"Could not cache the model catalog: {err}")
+
+
+_registry = ModelRegistry(_CHAT_MODELS, _EMBED_MODELS)
+
+
+def get_registry() -> ModelRegistry:
+    """The model registry in use."""
+    return _registry
+
+
+def set_registry(registry: ModelRegistry) -> None:
+    """
+    Replaces the model registry. Requests that already resolved their model
+    keep its old `ModelInfo`; later lookups see the new registry.
+    """
+    global _registry
+    _registry = registry
@@ -0,0 +1,282 @@
+import hashlib
+import math
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Callable, Coroutine, Dict, Optional, Tuple
+
+from aiohttp import web
+from loguru import logger
+
+from .metrics import record_completion_tokens, timed
+from .models import get_registry
+from .utils import calculate_prompt_tokens_async
+
+# Seconds between sweeps of the buckets of idle clients
+SWEEP_INTERVAL = 60.0
+
+# Charges completion tokens to the client of the request being handled
+_charge_completion: ContextVar[Optional[Callable[[int], None]]] = ContextVar(
+    "charge_completion", default=None
+)
+
+
+class TokenBucket:
+    """
+    Bucket of `capacity` units refilled continuously at `rate` units per
+    second. The level may go negative when a cost is only known after the
+    fact; the client then waits until the debt is refilled.
+    """
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._level = capacity
+        self._updated = now
+
+    def level(self, now: float) -> float:
+        self._level = min(
+            self.capacity, self._level + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        return self._level
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available."""
+        return max(0.0, (amount - self.level(now)) / self.rate)
+
+    def reset_time(self, now: float) -> float:
+        """Seconds until the bucket is full again."""
+        return self.wait_time(self.capacity, now)
+
+    def take(self, amount: float, now: float) -> None:
+        self._level = self.level(now) - amount
+
+
+@dataclass
+class ClientBuckets:
+    requests: Optional[TokenBucket]
+    tokens: Optional[TokenBucket]
+
+
+def format_duration(seconds: float) -> str:
+    """Formats a reset time the way OpenAI does, e.g. "250ms", "1.5s", "6m0s"."""
+    if seconds < 1:
+        return f"{math.ceil(seconds * 1000)}ms"
+    minutes, seconds = divmod(seconds, 60)
+    seconds = math.ceil(seconds * 10) / 10
+    text = f"{seconds:g}s"
+    return f"{int(minutes)}m{text}" if minutes else text
+
+
+class RateLimiter:
+    """
+    Per-client token buckets for requests per minute and tokens per minute.
+
+    A request is admitted when its client has a request left and enough
+    tokens for its prompt. Completion tokens are charged once known, which
+    may push the client into debt for its next requests. A prompt larger
+    than the whole per-minute budget is admitted once the bucket is full.
+    A limit of 0 disables that bucket.
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, key: str = "api_key"):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.key = key
+        self._clients: Dict[str, ClientBuckets] = {}
+        self._last_sweep = time.monotonic()
+
+    def configure(self, rpm: int = 0, tpm: int = 0, key: str = "api_key") -> None:
+        """Applies new limits; if they changed, every client starts afresh."""
+        if (rpm, tpm, key) != (self.rpm, self.tpm, self.key):
+            self.rpm, self.tpm, self.key = rpm, tpm, key
+            self._clients.clear()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def client_key(self, request: web.Request) -> str:
+        """Identifies the client by its API key, or its IP address."""
+        if self.key == "api_key":
+            auth = request.headers.get("Authorization", "")
+            scheme, _, api_key = auth.partition(" ")
+            if scheme.lower() == "bearer" and api_key.strip():
+                # Only a digest of the key is kept in memory
+                digest = hashlib.sha256(api_key.strip().encode()).hexdigest()
+                return f"key:{digest[:32]}"
+        return f"ip:{request.remote}"
+
+    def admit(self, client: str, prompt_tokens: int) -> Tuple[bool, Dict[str, str]]:
+        """
+        Takes one request and `prompt_tokens` tokens from `client`'s buckets
+        if both have enough left.
+
+        Returns:
+            Whether the request is admitted, and the rate limit headers.
+            Rejections include `Retry-After`.
+        """
+        now = time.monotonic()
+        self._sweep(now)
+        buckets = self._buckets(client, now)
+
+        wait = 0.0
+        if buckets.requests is not None:
+            wait = buckets.requests.wait_time(1, now)
+        if buckets.tokens is not None:
+            needed = min(prompt_tokens, self.tpm)
+            wait = max(wait, buckets.tokens.wait_time(needed, now))
+
+        if wait <= 0:
+            if buckets.requests is not None:
+                buckets.requests.take(1, now)
+            if buckets.tokens is not None:
+                buckets.tokens.take(prompt_tokens, now)
+
+        headers = self._headers(buckets, now)
+        if wait > 0:
+            headers["Retry-After"] = str(math.ceil(wait))
+            headers["retry-after-ms"] = str(math.ceil(wait * 1000))
+        return wait <= 0, headers
+
+    def charge(self, client: str, tokens: int) -> None:
+        """Charges tokens that were only known after admission."""
+        buckets = self._clients.get(client)
+        if buckets is not None and buckets.tokens is not None and tokens > 0:
+            buckets.tokens.take(tokens, time.monotonic())
+
+    def _buckets(self, client: str, now: float) -> ClientBuckets:
+        buckets = self._clients.get(client)
+        if buckets is None:
+            buckets = ClientBuckets(
+                TokenBucket(self.rpm, self.rpm / 60, now) if self.rpm else None,
+                TokenBucket(self.tpm, self.tpm / 60, now) if self.tpm else None,
+            )
+            self._clients[client] = buckets
+        return buckets
+
+    def _headers(self, buckets: ClientBuckets, now: float) -> Dict[str, str]:
+        headers = {}
+        for name, bucket in (
+            ("requests", buckets.requests),
+            ("tokens", buckets.tokens),
+        ):
+            if bucket is None:
+                continue
+            headers[f"x-ratelimit-limit-{name}"] = str(int(bucket.capacity))
+            headers[f"x-ratelimit-remaining-{name}"] = str(
+                max(0, math.floor(bucket.level(now)))
+            )
+            headers[f"x-ratelimit-reset-{name}"] = format_duration(
+                bucket.reset_time(now)
+            )
+        return headers
+
+    def _sweep(self, now: float) -> None:
+        """Drops the buckets of clients that have been idle long enough to refill."""
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for client, buckets in list(self._clients.items()):
+            if all(
+                bucket is None or bucket.level(now) >= bucket.capacity
+                for bucket in (buckets.requests, buckets.tokens)
+            ):
+                del self._clients[client]
+
+
+def charge_completion_tokens(tokens: int) -> None:
+    """
+    Charges `tokens` to the rate limit of the client of the current request,
+    and counts them in its metrics.
+    """
+    record_completion_tokens(tokens)
+    charge = _charge_completion.get()
+    if charge is not None:
+        charge(tokens)
+
+
+async def charging_completion(produce: Coroutine, count: Callable[[], int]) -> None:
+    """
+    Runs `produce` and then charges the `count()` completion tokens it
+    generated, even if it was cancelled midway.
+    """
+    try:
+        await produce
+    finally:
+        charge_completion_tokens(count())
+
+
+def counts_completion_tokens() -> bool:
+    """Whether completion tokens of the current request count against a limit."""
+    return _charge_completion.get() is not None
+
+
+def completion_usage_mode(usage_mode: str) -> str:
+    """
+    Usage mode for the completion tokens of the current request: `off`
+    becomes `estimate` when they count against a limit.
+    """
+    return (
+        "estimate" if usage_mode == "off" and counts_completion_tokens() else usage_mode
+    )
+
+
+async def _prompt_tokens(request: web.Request) -> int:
+    """Prompt tokens of the request body, counted with the route's usage mode."""
+    try:
+        with timed("parse"):
+            data = await request.json()
+        model = get_registry().canonical(data.get("model", ""))
+        mode = request["config"].token_usage_mode(model, request.path)
+        # The limit still needs a count when usage is not reported
+        mode = "estimate" if mode == "off" else mode
+        with timed("tokenize"):
+            return await calculate_prompt_tokens_async(data, model, mode)
+    except Exception as err:
+        # Malformed requests are rejected by the handler itself
+        logger.debug(f"Could not count prompt tokens for rate limiting: {err}")
+        return 0
+
+
+@web.middleware
+async def rate_limit_middleware(request: web.Request, handler):
+    """Applies the client's rate limits to proxied API requests."""
+    limiter: Optional[RateLimiter] = request.app.get("ratelimiter")
+    if (
+        limiter is None
+        or not limiter.enabled
+        or request.method != "POST"
+        or not request.path.startswith("/v1/")
+    ):
+        return await handler(request)
+
+    client = limiter.client_key(request)
+    prompt_tokens = await _prompt_tokens(request) if limiter.tpm else 0
+    admitted, headers = limiter.admit(client, prompt_tokens)
+    if not admitted:
+        logger.warning(f"Rate limit exceeded for {client} on {request.path}")
+        return web.json_response(
+            {
+                "error": {
+                    "message": "Rate limit exceeded, retry after "
+                    f"{headers['Retry-After']}s",
+                    "type": "rate_limit_exceeded",
+                }
+            },
+            status=HTTPStatus.TOO_MANY_REQUESTS,
+            headers=headers,
+        )
+
+    charger = (lambda tokens: limiter.charge(client, tokens)) if limiter.tpm else None
+    # Streams producing in the background inherit the charger with the context
+    reset = _charge_completion.set(charger)
+    try:
+        response = await handler(request)
+    finally:
+        _charge_completion.reset(reset)
+    if not response.prepared:
+        response.headers.update(headers)
+    return response
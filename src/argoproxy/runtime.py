@@ -0,0 +1,153 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Set, Tuple
+
+import aiohttp
+from aiohttp import web
+from loguru import logger
+
+from .config import ArgoConfig, load_config
+from .metrics import trace_config
+
+# Settings bound when the server starts; a reload keeps their old values
+RESTART_ONLY_FIELDS = ("host", "port", "server", "tiktoken_cache_dir")
+
+
+class Upstream:
+    """
+    Client session to the upstream API with the number of requests using it.
+
+    A reload replaces the session with a new one, and the old one is closed
+    once the requests and streams started on it have finished, so they are
+    not cut off.
+    """
+
+    def __init__(self):
+        self.session = aiohttp.ClientSession(trace_configs=[trace_config()])
+        self._users = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def acquire(self) -> aiohttp.ClientSession:
+        self._users += 1
+        self._idle.clear()
+        return self.session
+
+    def release(self) -> None:
+        self._users -= 1
+        if self._users == 0:
+            self._idle.set()
+
+    async def retire(self, app: web.Application) -> None:
+        """Closes the session once nothing uses it anymore."""
+        try:
+            await self._idle.wait()
+            # Streams outlive the request that started them
+            await app["streams"].wait_producers()
+        finally:
+            await self.session.close()
+
+
+@dataclass
+class Runtime:
+    """State of a running app that changes without a restart."""
+
+    config: Optional[ArgoConfig] = None
+    upstream: Optional[Upstream] = None
+    draining: bool = False  # set on SIGTERM, see server.run_server
+    # Replaced upstreams waiting for their last requests before closing
+    retiring: Set["asyncio.Task[None]"] = field(default_factory=set)
+
+    async def close(self) -> None:
+        """Closes the current and replaced upstream sessions."""
+        retiring = list(self.retiring)
+        for task in retiring:
+            task.cancel()
+        await asyncio.gather(*retiring, return_exceptions=True)
+        if self.upstream is not None:
+            await self.upstream.session.close()
+
+
+@web.middleware
+async def snapshot_middleware(request: web.Request, handler):
+    """
+    Pins the config and upstream session current when a request arrives,
+    so a reload midway does not mix old and new settings.
+    """
+    runtime: Runtime = request.app["runtime"]
+    request["config"] = runtime.config
+    upstream = runtime.upstream
+    request["session"] = upstream.acquire()
+    try:
+        return await handler(request)
+    finally:
+        upstream.release()
+
+
+def read_config(
+    old: ArgoConfig, config_path: Optional[str] = None
+) -> Tuple[ArgoConfig, List[str]]:
+    """
+    Re-reads and validates the config file, keeping the old values of the
+    settings that need a restart.
+
+    Returns:
+        The new config and the names of the settings that changed.
+
+    Raises:
+        ValueError: If no valid config could be loaded.
+        TypeError: If a setting has the wrong type, e.g. a string for a number.
+    """
+    new, path = load_config(config_path or os.getenv("CONFIG_PATH"))
+    if new is None:
+        raise ValueError("No valid configuration found")
+    new.check()
+
+    for name in RESTART_ONLY_FIELDS:
+        if getattr(new, name) != getattr(old, name):
+            logger.warning(
+                f"Changing `{name}` requires a restart, keeping the old value"
+            )
+            setattr(new, name, getattr(old, name))
+    changed = [
+        name
+        for name in old.__dataclass_fields__
+        if getattr(new, name) != getattr(old, name)
+    ]
+    logger.info(
+        f"Reloaded configuration from {path}, changed: {', '.join(changed) or 'nothing'}"
+    )
+    return new, changed
+
+
+async def reload_config(app: web.Application) -> List[str]:
+    """
+    Re-reads the config file, then swaps it in for new requests and
+    rebuilds the upstream session. In-flight requests and streams keep the
+    config and session they started with.
+
+    Returns:
+        The names of the settings that changed.
+
+    Raises:
+        ValueError: If no valid config could be loaded; the current one is kept.
+        TypeError: If a setting has the wrong type; the current one is kept.
+    """
+    runtime: Runtime = app["runtime"]
+    new, changed = read_config(runtime.config, app["config_path"])
+
+    old_upstream = runtime.upstream
+    runtime.config, runtime.upstream = new, Upstream()
+    app["streams"].configure(
+        new.stream_replay_ttl,
+        coalescing=new.stream_coalescing,
+        grace=new.stream_resume_grace,
+    )
+    app["ratelimiter"].configure(
+        new.rate_limit_rpm, new.rate_limit_tpm, key=new.rate_limit_key
+    )
+    retiring = asyncio.create_task(old_upstream.retire(app))
+    runtime.retiring.add(retiring)
+    retiring.add_done_callback(runtime.retiring.discard)
+    return changed
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import signal
+from datetime import datetime, timezone
+from typing import Any, Set
+
+from aiohttp import web
+from aiohttp.abc import AbstractAccessLogger
+from loguru import logger
+
+from .config import ServerConfig
+from .runtime import reload_config
+
+
+def new_event_loop(kind: str = "auto") -> asyncio.AbstractEventLoop:
+    """Creates the event loop the server runs on.
+
+    Args:
+        kind (str): "uvloop", "asyncio", or "auto" to use uvloop if installed.
+    """
+    if kind != "asyncio":
+        try:
+            import uvloop  # type: ignore
+        except ImportError:
+            if kind == "uvloop":
+                raise RuntimeError(
+                    "server.loop is 'uvloop' but uvloop is not installed; "
+                    "install it with `pip install argo-proxy[speed]`"
+                )
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class _LoguruHandler(logging.Handler):
+    """Forwards records of a standard logger to loguru."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logger.log(record.levelname, record.getMessage())
+
+
+def _access_logger() -> logging.Logger:
+    access_logger = logging.getLogger("argoproxy.access")
+    if not access_logger.handlers:
+        access_logger.addHandler(_LoguruHandler())
+        access_logger.setLevel(logging.INFO)
+        access_logger.propagate = False
+    return access_logger
+
+
+class JsonAccessLogger(AbstractAccessLogger):
+    """
+    Logs a JSON object per request, with the route and model of the request
+    and the seconds it spent waiting for the upstream. Lines are written
+    without the time prefix of the other logs, so each is a JSON document.
+    """
+
+    def log(
+        self, request: web.BaseRequest, response: web.StreamResponse, time: float
+    ) -> None:
+        entry = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "remote": request.remote,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status,
+            "bytes": response.body_length,
+            "duration": round(time, 6),
+            "user_agent": request.headers.get("User-Agent"),
+        }
+        current = request.get("request_metrics")
+        if current is not None:
+            entry["route"] = current.route.route
+            entry["model"] = current.model.model or None
+            entry["upstream"] = round(current.upstream_seconds(), 6)
+        logger.opt(raw=True).info(json.dumps(entry) + "\n")
+
+
+def _handle_signals(server: ServerConfig):
+    """
+    Returns a startup hook making SIGTERM and SIGINT drain the server, and
+    SIGHUP reload its config.
+
+    On SIGTERM, the server keeps accepting connections for `drain_delay`
+    seconds while /health reports it as draining, so load balancers can
+    route new requests elsewhere. Then it stops listening and waits up to
+    `drain_timeout` seconds for in-flight requests and streams to finish.
+    A second signal stops it at once.
+    """
+
+    async def install(app: web.Application) -> None:
+        loop = asyncio.get_running_loop()
+        runtime = app["runtime"]
+
+        def stop() -> None:
+            raise web.GracefulExit()
+
+        def drain() -> None:
+            if runtime.draining:
+                stop()
+            runtime.draining = True
+            logger.info(
+                f"Draining: closing in {server.drain_delay:g}s, then waiting up "
+                f"to {server.drain_timeout:g}s for in-flight requests"
+            )
+            loop.call_later(server.drain_delay, stop)
+
+        async def reload() -> None:
+            try:
+                await reload_config(app)
+            except Exception as err:
+                logger.error(f"Configuration not reloaded: {err}")
+
+        def start_reload() -> None:
+            task = loop.create_task(reload())
+            reloads.add(task)
+            task.add_done_callback(reloads.discard)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, drain)
+        loop.add_signal_handler(signal.SIGHUP, start_reload)
+
+    reloads: Set["asyncio.Task[None]"] = set()  # keeps running reloads alive
+    return install
+
+
+def run_server(app: web.Application, server: ServerConfig, **kwargs: Any) -> None:
+    """Runs `app` with the `server` config section until it is drained.
+
+    Args:
+        app: The application to serve.
+        server: The `server` config section.
+        **kwargs: Further arguments of `web.run_app`, e.g. host and port.
+    """
+    app.on_startup.append(_handle_signals(server))
+    if server.access_log_format == "json":
+        kwargs.setdefault("access_log_class", JsonAccessLogger)
+    web.run_app(
+        app,
+        loop=new_event_loop(server.loop),
+        backlog=server.backlog,
+        keepalive_timeout=server.keepalive_timeout,
+        # aiohttp formats access log lines only if a logger is given
+        access_log=_access_logger() if server.access_log else None,
+        access_log_format=server.access_log_format,
+        reuse_port=kwargs.pop("reuse_port", server.reuse_port),
+        shutdown_timeout=server.drain_timeout,
+        handle_signals=False,
+        **kwargs,
+    )
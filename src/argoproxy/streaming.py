@@ -0,0 +1,565 @@
+import asyncio
+import hashlib
+import json
+import tempfile
+import uuid
+from dataclasses import dataclass
+from typing import (
+    IO,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import aiohttp
+from aiohttp import web
+from loguru import logger
+
+DEFAULT_SPILL_THRESHOLD = 1024 * 1024  # 1 MiB kept in memory per stream
+DEFAULT_REPLAY_TTL = 60  # seconds a finished stream stays resumable
+DEFAULT_RESUME_GRACE = 10  # seconds a stream without readers keeps generating
+
+# SSE comment, ignored by clients. Without a blank line after it, so it
+# never ends an event: clients keeping the last event id would otherwise
+# dispatch an empty event for it.
+HEARTBEAT = b": keep-alive\n"
+
+
+class StreamBuffer:
+    """
+    Append-only log of outgoing stream chunks that decouples the upstream
+    producer from the downstream reader.
+
+    The first `spill_threshold` bytes are kept in memory; later chunks are
+    appended to an anonymous temporary file, so a slow client never holds
+    more than the threshold in memory nor applies backpressure upstream.
+    It exposes the same `write` coroutine as `web.StreamResponse`, so it
+    can be handed to `send_off_sse` in place of the response.
+    """
+
+    def __init__(self, spill_threshold: int = DEFAULT_SPILL_THRESHOLD):
+        self.spill_threshold = spill_threshold
+        self._memory: List[bytes] = []
+        self._memory_bytes = 0
+        self._spilled: List[Tuple[int, int]] = []  # (offset, length) in spill file
+        self._spill_file: Optional[IO[bytes]] = None
+        self._spill_bytes = 0
+        self._closed = False
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._memory) + len(self._spilled)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill_file is not None
+
+    async def write(self, data: bytes) -> None:
+        """Appends a chunk to the buffer. Never blocks on the reader."""
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed stream buffer")
+
+        # Once spilling has started every later chunk goes to disk to keep order
+        if (
+            self._spill_file is None
+            and self._memory_bytes + len(data) <= self.spill_threshold
+        ):
+            self._memory.append(data)
+            self._memory_bytes += len(data)
+        else:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(prefix="argoproxy-stream-")
+            self._spill_file.seek(self._spill_bytes)
+            self._spill_file.write(data)
+            self._spilled.append((self._spill_bytes, len(data)))
+            self._spill_bytes += len(data)
+        self._notify()
+
+    def close(self) -> None:
+        """Marks the end of the stream; readers finish after the last chunk."""
+        self._closed = True
+        self._notify()
+
+    def discard(self) -> None:
+        """Closes the buffer and frees the spill file, if any."""
+        self.close()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+            self._spilled.clear()
+        self._memory.clear()
+
+    def get_chunk(self, index: int) -> bytes:
+        if index < len(self._memory):
+            return self._memory[index]
+        if self._spill_file is None:
+            raise IndexError(index)
+        offset, length = self._spilled[index - len(self._memory)]
+        self._spill_file.seek(offset)
+        return self._spill_file.read(length)
+
+    async def iter_chunks(
+        self, start: int = 0, idle_timeout: Optional[float] = None
+    ) -> AsyncIterator[Optional[bytes]]:
+        """
+        Yields chunks from `start` onwards, waiting for new ones until the
+        buffer is closed.
+
+        If `idle_timeout` is set, None is yielded whenever no chunk arrived
+        for that many seconds.
+        """
+        index = start
+        while True:
+            if index < len(self):
+                yield self.get_chunk(index)
+                index += 1
+                continue
+            if self._closed:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), idle_timeout)
+            except asyncio.TimeoutError:
+                yield None
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+def start_producer(
+    produce: Coroutine,
+    upstream_resp: aiohttp.ClientResponse,
+    stream_buffer: StreamBuffer,
+) -> "asyncio.Task[None]":
+    """
+    Runs `produce` in the background to drain the upstream response into
+    `stream_buffer` at full speed.
+
+    The upstream connection is released as soon as `produce` finishes,
+    independently of how fast the client reads the buffer. If `produce`
+    returns before the upstream body is exhausted, e.g. on a stop sequence,
+    the connection is closed so the upstream stops generating.
+    """
+
+    async def _run() -> None:
+        try:
+            await produce
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(f"Upstream stream aborted: {err}")
+        finally:
+            if upstream_resp.content.at_eof():
+                upstream_resp.release()
+            else:
+                upstream_resp.close()
+            stream_buffer.close()
+
+    return asyncio.create_task(_run())
+
+
+@dataclass
+class LiveStream:
+    """An upstream stream being drained into a buffer, with its subscribers."""
+
+    buffer: StreamBuffer
+    producer: "asyncio.Task[None]"
+    status: int
+    headers: Dict[str, str]
+    stream_id: Optional[str] = None  # set when the stream is resumable
+    key: Optional[str] = None  # set when the stream can be coalesced
+    heartbeat: Optional[float] = None  # seconds between keep-alive comments
+    subscribers: int = 0
+    idle_timer: Optional[asyncio.TimerHandle] = None  # cancels it when unread
+
+
+class StreamRegistry:
+    """
+    Tracks live and recently finished streams.
+
+    Resumable streams are addressable by id: they keep generating into their
+    buffer for `grace` seconds after every client went away, and stay
+    available for replay `ttl` seconds after the upstream finished. If
+    nobody resumed within the grace period the upstream is cancelled, so
+    abandoned streams do not keep generating. A `ttl` of 0 disables
+    resumption.
+
+    With `coalescing` on, identical deterministic requests share one
+    upstream stream while it is live; late subscribers get the
+    already-emitted prefix replayed before the live chunks.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_REPLAY_TTL,
+        coalescing: bool = False,
+        grace: float = DEFAULT_RESUME_GRACE,
+    ):
+        self.ttl = ttl
+        self.coalescing = coalescing
+        self.grace = grace
+        self._streams: Dict[str, LiveStream] = {}
+        self._producers: Set["asyncio.Task[None]"] = set()
+        self._live: Dict[str, Union[LiveStream, "asyncio.Future[Any]"]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def configure(
+        self, ttl: float, coalescing: bool, grace: float = DEFAULT_RESUME_GRACE
+    ) -> None:
+        """Applies new settings to streams opened from now on."""
+        self.ttl = ttl
+        self.coalescing = coalescing
+        self.grace = grace
+
+    async def wait_producers(self) -> None:
+        """Waits until the streams generating now have finished."""
+        if self._producers:
+            await asyncio.wait(set(self._producers))
+
+    @property
+    def active(self) -> int:
+        """Number of upstream streams still generating."""
+        return len(self._producers)
+
+    def coalescing_key(self, endpoint: str, data: Dict[str, Any]) -> Optional[str]:
+        """
+        Returns the key under which a streaming request can be shared, or
+        None if it must get its own upstream stream.
+
+        Only deterministic requests (`temperature` 0 or a `seed`) are shared,
+        since sampled requests are expected to differ.
+        """
+        if not self.coalescing:
+            return None
+        if data.get("temperature") != 0 and data.get("seed") is None:
+            return None
+        payload = json.dumps([endpoint, data], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def join(
+        self, key: Optional[str]
+    ) -> Union[LiveStream, "asyncio.Future[Optional[LiveStream]]", None]:
+        """
+        Returns the live stream matching `key`, or a future resolving to it
+        if its upstream request is still being sent, see `join_stream`.
+        The future resolves to None if that request is abandoned.
+
+        If there is none, `key` is reserved for the caller, who must then
+        either `open` the stream with it or `abandon` it.
+        """
+        if key is None:
+            return None
+        entry = self._live.get(key)
+        if isinstance(entry, asyncio.Future):
+            return entry
+        if entry is not None and not entry.producer.done():
+            return entry
+        self._live[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def abandon(self, key: Optional[str]) -> None:
+        """Releases a reserved key; waiting duplicates go upstream on their own."""
+        entry = self._live.pop(key, None) if key is not None else None
+        if isinstance(entry, asyncio.Future) and not entry.done():
+            entry.set_result(None)
+
+    def open(
+        self,
+        stream_buffer: StreamBuffer,
+        producer: "asyncio.Task[None]",
+        status: int,
+        headers: Dict[str, str],
+        *,
+        resumable: bool = True,
+        key: Optional[str] = None,
+        heartbeat: Optional[float] = None,
+    ) -> LiveStream:
+        live = LiveStream(
+            stream_buffer, producer, status, headers, key=key, heartbeat=heartbeat
+        )
+
+        if resumable and self.enabled:
+            live.stream_id = uuid.uuid4().hex
+            live.headers["X-Stream-Id"] = live.stream_id
+            self._streams[live.stream_id] = live
+
+        if key is not None:
+            reserved = self._live.get(key)
+            self._live[key] = live
+            if isinstance(reserved, asyncio.Future) and not reserved.done():
+                reserved.set_result(live)
+
+        self._producers.add(producer)
+        producer.add_done_callback(lambda _: self._finish(live))
+        return live
+
+    def get(self, stream_id: str) -> Optional[LiveStream]:
+        return self._streams.get(stream_id)
+
+    def detach(self, live: LiveStream) -> None:
+        """
+        Called when a subscriber leaves. A stream that nobody reads and
+        nobody can resume is stopped right away, a resumable one after the
+        grace period unless a client resumed it meanwhile.
+        """
+        live.subscribers -= 1
+        if live.subscribers > 0:
+            return
+        if live.stream_id in self._streams:
+            if live.idle_timer is not None:
+                live.idle_timer.cancel()
+            if not live.producer.done():
+                live.idle_timer = asyncio.get_running_loop().call_later(
+                    self.grace, self._cancel_if_unread, live
+                )
+            return
+        self._forget(live)
+        if not live.producer.done():
+            live.producer.cancel()
+        # Freed once the producer stopped writing to it
+        live.producer.add_done_callback(lambda _: live.buffer.discard())
+
+    def close(self) -> None:
+        """Stops all live producers and frees every buffer."""
+        for producer in list(self._producers):
+            producer.cancel()
+        for live in list(self._streams.values()):
+            live.buffer.discard()
+        self._streams.clear()
+        for key in list(self._live):
+            self.abandon(key)
+
+    def _cancel_if_unread(self, live: LiveStream) -> None:
+        live.idle_timer = None
+        if live.subscribers == 0 and not live.producer.done():
+            logger.info(f"Stream {live.stream_id} abandoned, cancelling upstream")
+            live.producer.cancel()
+
+    def _finish(self, live: LiveStream) -> None:
+        self._producers.discard(live.producer)
+        if live.key is not None and self._live.get(live.key) is live:
+            del self._live[live.key]
+        if live.stream_id is not None:
+            asyncio.get_running_loop().call_later(self.ttl, self._expire, live)
+
+    def _expire(self, live: LiveStream) -> None:
+        self._forget(live)
+        if live.subscribers == 0:
+            live.buffer.discard()
+
+    def _forget(self, live: LiveStream) -> None:
+        if live.stream_id is not None:
+            self._streams.pop(live.stream_id, None)
+        if live.key is not None and self._live.get(live.key) is live:
+            del self._live[live.key]
+
+
+def parse_last_event_id(last_event_id: Optional[str]) -> int:
+    """
+    Returns the index of the first chunk to replay for a `Last-Event-ID`
+    of the form `<stream_id>:<index>` or `<index>`.
+    """
+    if not last_event_id:
+        return 0
+    try:
+        return int(last_event_id.rsplit(":", 1)[-1]) + 1
+    except ValueError:
+        raise ValueError(f"Invalid Last-Event-ID: {last_event_id}")
+
+
+async def relay_to_client(
+    stream_buffer: StreamBuffer,
+    response: web.StreamResponse,
+    start: int = 0,
+    stream_id: Optional[str] = None,
+    heartbeat: Optional[float] = None,
+) -> None:
+    """
+    Feeds buffered chunks to the client at its own pace.
+
+    When `stream_id` is given, every chunk is a complete SSE event and is
+    tagged with an `id: <stream_id>:<index>` line so it can be resumed;
+    comment chunks, starting with ":", are sent as they are.
+    When `heartbeat` is given, an SSE comment is sent every `heartbeat`
+    seconds spent waiting for upstream bytes, so idle connections are not
+    dropped by proxies or client timeouts.
+    """
+    index = start
+    async for chunk in stream_buffer.iter_chunks(start, idle_timeout=heartbeat):
+        if chunk is None:
+            await response.write(HEARTBEAT)
+            continue
+        if stream_id is not None and not chunk.startswith(b":"):
+            chunk = f"id: {stream_id}:{index}\n".encode() + chunk
+        await response.write(chunk)
+        index += 1
+
+
+async def keep_alive_until(
+    request: web.Request,
+    waiting: "asyncio.Future[Any]",
+    headers: Dict[str, str],
+    heartbeat: Optional[float],
+    response: Optional[web.StreamResponse] = None,
+) -> Optional[web.StreamResponse]:
+    """
+    Waits for `waiting`, keeping the client connection alive meanwhile.
+
+    If it takes longer than `heartbeat` seconds, the client response is
+    prepared early with status 200 and `headers`, and a heartbeat is sent
+    every `heartbeat` seconds until it is done. A `response` that was
+    already prepared gets heartbeats right away. `waiting` is never
+    cancelled, even if the client goes away.
+
+    Returns:
+        The client response if it was prepared.
+    """
+    if response is None:
+        done, _ = await asyncio.wait({waiting}, timeout=heartbeat or None)
+        if done:
+            return None
+        response = web.StreamResponse(status=200, headers=headers)
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+    while not waiting.done():
+        await response.write(HEARTBEAT)
+        await asyncio.wait({waiting}, timeout=heartbeat or None)
+    return response
+
+
+async def join_stream(
+    request: web.Request,
+    registry: StreamRegistry,
+    key: Optional[str],
+    heartbeat: Optional[float],
+) -> Tuple[Optional[LiveStream], Optional[web.StreamResponse]]:
+    """
+    Joins the live stream matching `key`, see `StreamRegistry.join`. While
+    its upstream request is still being sent, the client gets heartbeats
+    as if it had sent the request itself, see `keep_alive_until`.
+
+    Returns:
+        The live stream, None if there is none and the caller must go
+        upstream itself, and the client response if it was prepared early.
+        Coalesced streams are SSE, so it was prepared as one.
+    """
+    joined = registry.join(key)
+    if not isinstance(joined, asyncio.Future):
+        return joined, None
+    response = await keep_alive_until(
+        request, joined, {"Content-Type": "text/event-stream"}, heartbeat
+    )
+    return joined.result(), response
+
+
+async def await_upstream(
+    request: web.Request,
+    pending: Awaitable[aiohttp.ClientResponse],
+    headers: Dict[str, str],
+    heartbeat: Optional[float],
+    sse: bool = True,
+    response: Optional[web.StreamResponse] = None,
+) -> Tuple[Optional[aiohttp.ClientResponse], Optional[web.StreamResponse]]:
+    """
+    Awaits the upstream response headers, keeping the client connection
+    alive while the upstream is still queueing or thinking.
+
+    If the headers take longer than `heartbeat` seconds, the client response
+    is prepared early with status 200 and `headers`, and a heartbeat is sent
+    every `heartbeat` seconds until they arrive. Upstream headers, and the
+    `X-Stream-Id` header, can then no longer be forwarded; the stream id is
+    still sent in each event's `id:` line. A `response` already prepared,
+    e.g. by `join_stream`, is used the same way.
+
+    Returns:
+        The upstream response and the client response if it was prepared
+        early. Once the client response is prepared, upstream failures are
+        reported in the stream itself; the upstream response is then None
+        and the client response is complete.
+    """
+    task = asyncio.ensure_future(pending)
+    if not heartbeat and response is None:
+        return await task, None
+    try:
+        response = await keep_alive_until(request, task, headers, heartbeat, response)
+    except BaseException:
+        # The client went away before the upstream answered
+        task.cancel()
+        task.add_done_callback(_close_upstream)
+        raise
+    if response is None:
+        return task.result(), None
+
+    try:
+        upstream_resp = task.result()
+        if upstream_resp.status == 200:
+            return upstream_resp, response
+        error = (
+            f"Upstream API error: {upstream_resp.status} {await upstream_resp.text()}"
+        )
+        upstream_resp.release()
+    except aiohttp.ClientError as err:
+        error = f"HTTP error occurred: {err}"
+    logger.error(f"Stream failed after its response started: {error}")
+    if sse:
+        await response.write(f"data: {json.dumps({'error': error})}\n\n".encode())
+    else:
+        await response.write(error.encode())
+    await response.write_eof()
+    return None, response
+
+
+def _close_upstream(task: "asyncio.Future[aiohttp.ClientResponse]") -> None:
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
+async def serve_stream(
+    request: web.Request,
+    registry: StreamRegistry,
+    live: LiveStream,
+    start: int = 0,
+    response: Optional[web.StreamResponse] = None,
+) -> web.StreamResponse:
+    """
+    Subscribes a client to `live`, starting at chunk `start`. Each
+    subscriber reads independently and may disconnect without affecting
+    the others. `response` is used instead of a new one if it was
+    already prepared.
+    """
+    live.subscribers += 1
+    try:
+        if response is None:
+            response = web.StreamResponse(status=live.status, headers=live.headers)
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+
+        await relay_to_client(
+            live.buffer,
+            response,
+            start,
+            stream_id=live.stream_id,
+            heartbeat=live.heartbeat,
+        )
+
+        # Ensure response is properly closed
+        await response.write_eof()
+
+        return response
+    finally:
+        registry.detach(live)
@@ -1,31 +1,83 @@
-from .chat_completion import (
-    # response type
-    ChatCompletion,  # non-streaming
-    ChatCompletionChunk,  # streaming
-    # message type
-    ChatCompletionMessage,  # non-streaming
-    ChoiceDelta,  # streaming
-    # choice type
-    NonStreamChoice,  # non-streaming
-    StreamChoice,  # streaming
-)
-from .completions import Completion, CompletionChoice, CompletionUsage
-from .embedding import CreateEmbeddingResponse, Embedding, Usage
-from .responses import (
-    Response,
-    ResponseCompletedEvent,
-    ResponseContentPartAddedEvent,
-    ResponseContentPartDoneEvent,
-    ResponseCreatedEvent,
-    ResponseInProgressEvent,
-    ResponseOutputItemAddedEvent,
-    ResponseOutputItemDoneEvent,
-    ResponseOutputMessage,
-    ResponseOutputText,
-    ResponseTextDeltaEvent,
-    ResponseTextDoneEvent,
-    ResponseUsage,
-)
+"""
+The pydantic types of the OpenAI API responses.
+
+Each submodule is imported the first time one of its types is accessed,
+since pydantic models are slow to build.
+"""
+
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .chat_completion import (
+        # response type
+        ChatCompletion,  # non-streaming
+        ChatCompletionChunk,  # streaming
+        # message type
+        ChatCompletionMessage,  # non-streaming
+        ChoiceDelta,  # streaming
+        # choice type
+        NonStreamChoice,  # non-streaming
+        StreamChoice,  # streaming
+    )
+    from .completions import Completion, CompletionChoice, CompletionUsage
+    from .embedding import CreateEmbeddingResponse, Embedding, Usage
+    from .responses import (
+        Response,
+        ResponseCompletedEvent,
+        ResponseContentPartAddedEvent,
+        ResponseContentPartDoneEvent,
+        ResponseCreatedEvent,
+        ResponseInProgressEvent,
+        ResponseOutputItemAddedEvent,
+        ResponseOutputItemDoneEvent,
+        ResponseOutputMessage,
+        ResponseOutputText,
+        ResponseTextDeltaEvent,
+        ResponseTextDoneEvent,
+        ResponseUsage,
+    )
+
+_SUBMODULES = {
+    ".chat_completion": (
+        "ChatCompletion",
+        "ChatCompletionChunk",
+        "ChatCompletionMessage",
+        "ChoiceDelta",
+        "NonStreamChoice",
+        "StreamChoice",
+    ),
+    ".completions": ("Completion", "CompletionChoice", "CompletionUsage"),
+    ".embedding": ("CreateEmbeddingResponse", "Embedding", "Usage"),
+    ".responses": (
+        "Response",
+        "ResponseCompletedEvent",
+        "ResponseContentPartAddedEvent",
+        "ResponseContentPartDoneEvent",
+        "ResponseCreatedEvent",
+        "ResponseInProgressEvent",
+        "ResponseOutputItemAddedEvent",
+        "ResponseOutputItemDoneEvent",
+        "ResponseOutputMessage",
+        "ResponseOutputText",
+        "ResponseTextDeltaEvent",
+        "ResponseTextDoneEvent",
+        "ResponseUsage",
+    ),
+}
+_TYPE_MODULES = {
+    name: module for module, names in _SUBMODULES.items() for name in names
+}
+
+
+def __getattr__(name: str):
+    module = _TYPE_MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value  # later accesses skip __getattr__
+    return value
+
 
 __all__ = [
     # Embedding-related types
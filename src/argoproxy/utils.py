@@ -1,23 +1,70 @@
+import asyncio
+import hashlib
 import json
+import math
+import os
 import random
 import socket
-from typing import Any, Dict, List, Optional, Union
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
 import tiktoken
-from aiohttp import web
 from loguru import logger
 
-from .constants import ALL_MODELS, TIKTOKEN_ENCODING_PREFIX_MAPPING
+from .models import encoding_for, get_registry
+
+if TYPE_CHECKING:  # aiohttp is not needed by `argo-proxy --validate`
+    from aiohttp import web
+
+    from .streaming import StreamBuffer
+
+# Inputs shorter than this many characters are tokenized inline on the event
+# loop; handing them to a worker thread would cost more than encoding them.
+TOKENIZE_INLINE_THRESHOLD = 16 * 1024
+TOKENIZER_WORKERS = min(4, os.cpu_count() or 1)
+
+# Number of per-message token counts remembered across requests
+TOKEN_COUNT_CACHE_SIZE = 8192
+
+_tokenizer_pool: Optional[ThreadPoolExecutor] = None
+
+# How `usage` token counts are obtained, see ArgoConfig.usage_mode
+USAGE_MODES = ("exact", "estimate", "off")
+
+# Token estimator rates per encoding: (ASCII characters per token, tokens per
+# extra UTF-8 byte of non-ASCII text). These are the usual rules of thumb
+# (about 4 characters per English token, roughly a token per extra byte
+# pair), not yet fitted on a measured corpus; refit them with the rates
+# printed by dev_scripts/bench_usage_estimate.py
+TOKEN_ESTIMATE_RATES = {
+    "o200k_base": (4.2, 0.35),
+    "cl100k_base": (4.0, 0.45),
+}
+
+# Items of each list kept in payloads logged by verbose, e.g. of embedding
+# inputs or vectors, unless verbose_max_string is 0
+VERBOSE_MAX_ITEMS = 16
+
+# Encodings loaded before the server starts serving
+WARMUP_ENCODINGS = ("o200k_base", "cl100k_base")
+# Seconds to wait for the warm-up before serving anyway
+TOKENIZER_WARMUP_TIMEOUT = 30.0
+# Encoding files shipped with the package, if the build bundled them
+BUNDLED_TIKTOKEN_CACHE = os.path.join(os.path.dirname(__file__), "tiktoken_cache")
 
 
 async def send_off_sse(
-    response: web.StreamResponse, data: Union[Dict[str, Any], bytes]
+    response: Union["web.StreamResponse", "StreamBuffer"],
+    data: Union[Dict[str, Any], bytes],
 ) -> None:
     """
     Sends a chunk of data as a Server-Sent Events (SSE) event.
 
     Args:
-        response (web.StreamResponse): The response object used to send the SSE event.
+        response (Union[web.StreamResponse, StreamBuffer]): The response object, or the
+            stream buffer feeding it, used to send the SSE event.
         data (Union[Dict[str, Any], bytes]): The chunk of data to be sent as an SSE event.
             It can be either a dictionary (which will be converted to a JSON string and then to bytes)
             or preformatted bytes.
@@ -42,6 +89,55 @@ def make_bar(message: str = "", bar_length=40) -> str:
     return message
 
 
+def truncate_payload(value: Any, max_string: int) -> Any:
+    """
+    A copy of the JSON value `value` for logging, with strings cut to
+    `max_string` characters and lists to VERBOSE_MAX_ITEMS items, each
+    followed by how much was cut. `value` itself if `max_string` is 0.
+    """
+    if not max_string:
+        return value
+    if isinstance(value, str):
+        if len(value) <= max_string:
+            return value
+        return f"{value[:max_string]}... ({len(value) - max_string} more characters)"
+    if isinstance(value, dict):
+        return {key: truncate_payload(item, max_string) for key, item in value.items()}
+    if isinstance(value, list):
+        kept = [
+            truncate_payload(item, max_string) for item in value[:VERBOSE_MAX_ITEMS]
+        ]
+        if len(value) > VERBOSE_MAX_ITEMS:
+            kept.append(f"... ({len(value) - VERBOSE_MAX_ITEMS} more items)")
+        return kept
+    return value
+
+
+def log_payload(request: "web.Request", title: str, payload: Any) -> None:
+    """
+    Logs `payload` as indented JSON under `title`, if `verbose` is on and
+    the request is sampled, see ArgoConfig.verbose_sample_rate. A request
+    is sampled once, so all of its payloads are logged or none.
+
+    Strings and lists are truncated and the output capped to
+    `verbose_max_payload` characters before logging, so large prompts and
+    embedding inputs cost little to log.
+    """
+    config = request["config"]
+    sampled = request.get("verbose_sampled")
+    if sampled is None:
+        rate = config.verbose_sample_rate(request.path)
+        sampled = request["verbose_sampled"] = random.random() < rate
+    if not sampled:
+        return
+
+    text = json.dumps(truncate_payload(payload, config.verbose_max_string), indent=4)
+    limit = config.verbose_max_payload
+    if limit and len(text) > limit:
+        text = f"{text[:limit]}\n... ({len(text) - limit} more characters)"
+    logger.info(f"{make_bar(title)}\n{text}\n{make_bar()}")
+
+
 def validate_input(json_input: dict, endpoint: str) -> bool:
     """
     Validates the input JSON to ensure it contains the necessary fields.
@@ -100,13 +196,17 @@ def get_random_port(low: int, high: int) -> int:
     raise ValueError(f"No available port found in the range {low}-{high}.")
 
 
-def is_port_available(port: int, timeout: float = 0.1) -> bool:
+def is_port_available(
+    port: int, timeout: float = 0.1, reuse_port: bool = False
+) -> bool:
     """
     Checks if a given port is available (not already in use).
 
     Args:
         port (int): The port number to check.
         timeout (float): Timeout in seconds for the connection attempt.
+        reuse_port (bool): Whether the port may be shared through SO_REUSEPORT
+            with a process that listens on it the same way.
 
     Returns:
         bool: True if the port is available, False otherwise.
@@ -115,6 +215,8 @@ def is_port_available(port: int, timeout: float = 0.1) -> bool:
         try:
             with socket.socket(family, socket.SOCK_STREAM) as s:
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 s.settimeout(timeout)
                 s.bind(("127.0.0.1", port))
                 s.close()
@@ -124,66 +226,366 @@ def is_port_available(port: int, timeout: float = 0.1) -> bool:
     return False
 
 
-def resolve_model_name(
-    model_name: str,
-    default_model: str,
-    avail_models: Optional[Dict[str, str]] = None,
-) -> str:
+def resolve_model_name(model_name: str, default_model: str, kind: str = "chat") -> str:
     """
-    Resolves a model name to its primary model name using the flattened model mapping.
+    Resolves a model name to its primary model name using the model registry.
 
     Args:
-        model_name: The input model name to resolve
-        model_mapping: Dictionary mapping primary names to aliases (unused)
-        default_model: Default model name to return if no match found
+        model_name: The input model name to resolve, an alias or primary name
+        default_model: Primary name of the model to use if no match found
+        kind: "chat" or "embed", models of the other kind are not matched
 
     Returns:
         The resolved primary model name or default_model if no match found
     """
-    if not avail_models:
-        avail_models = ALL_MODELS
+    return get_registry().resolve(model_name, kind, default_model).name
 
-    if model_name in avail_models.values():
-        return model_name
 
-    # Check if input exists in the flattened mapping
-    if model_name in avail_models:
-        return avail_models[model_name]
+def get_tiktoken_encoding_model(model: str) -> str:
+    """
+    Get tiktoken encoding name for a given model, an alias or primary name.
+    Unknown models get the encoding of their name prefix, see `encoding_for`.
+    """
+    info = get_registry().get(model)
+    return info.encoding if info is not None else encoding_for(model)
 
-    return avail_models[default_model]
 
+class TokenCountCache:
+    """
+    Bounded LRU cache of token counts keyed by (encoding, content hash).
 
-def get_tiktoken_encoding_model(model: str) -> str:
+    Chat clients resend the whole conversation on every turn, so with the
+    earlier messages cached only the newly added ones need to be encoded.
+    Safe to share between the event loop and the tokenizer threads.
     """
-    Get tiktoken encoding name for a given model.
-    If the model starts with 'argo:', use TIKTOKEN_ENCODING_PREFIX_MAPPING to find encoding.
-    Otherwise use MODEL_TO_ENCODING mapping.
+
+    def __init__(self, maxsize: int = TOKEN_COUNT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._counts: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(encoding_name: str, text: str) -> Tuple[str, bytes]:
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        return encoding_name, digest
+
+    def get(self, key: Tuple[str, bytes]) -> Optional[int]:
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+            return count
+
+    def put(self, key: Tuple[str, bytes], count: int) -> None:
+        with self._lock:
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+
+token_count_cache = TokenCountCache()
+
+
+def _count_cached(
+    encoding: tiktoken.Encoding, texts: List[str], batch: bool = False
+) -> int:
+    """Sum the token counts of `texts`, encoding only those not cached yet."""
+    total = 0
+    missing: List[Tuple[Tuple[str, bytes], str]] = []
+    for text in texts:
+        key = token_count_cache.key(encoding.name, text)
+        count = token_count_cache.get(key)
+        if count is None:
+            missing.append((key, text))
+        else:
+            total += count
+
+    if missing:
+        missing_texts = [text for _, text in missing]
+        if batch:
+            encoded = encoding.encode_batch(missing_texts)
+        else:
+            encoded = [encoding.encode(text) for text in missing_texts]
+        for (key, _), tokens in zip(missing, encoded):
+            token_count_cache.put(key, len(tokens))
+            total += len(tokens)
+    return total
+
+
+def _estimate(text: str, encoding_name: str) -> float:
+    chars_per_token, tokens_per_extra_byte = TOKEN_ESTIMATE_RATES.get(
+        encoding_name, TOKEN_ESTIMATE_RATES["cl100k_base"]
+    )
+    if text.isascii():
+        return len(text) / chars_per_token
+    # Bytes beyond one per character: 1 per Cyrillic or Greek letter, 2 per CJK
+    extra = len(text.encode("utf-8")) - len(text)
+    return max(len(text) - extra, 0) / chars_per_token + extra * tokens_per_extra_byte
+
+
+def estimate_tokens(text: Union[str, List[str]], model: str) -> int:
     """
-    if model.startswith("argo:"):
-        model = ALL_MODELS[model]
+    Approximate token count from character and UTF-8 byte lengths, without
+    running the tokenizer.
 
-    for prefix, encoding in TIKTOKEN_ENCODING_PREFIX_MAPPING.items():
-        if model == prefix:
-            return encoding
-        if model.startswith(prefix):
-            return encoding
-    return "cl100k_base"
+    ASCII text is divided by the characters-per-token rate of the model's
+    encoding, non-ASCII text is weighted by its extra UTF-8 bytes. Each
+    non-empty text counts at least one token. See README for error bounds.
+    """
+    encoding_name = get_tiktoken_encoding_model(model)
+    texts = [text] if isinstance(text, str) else text
+    return sum(math.ceil(_estimate(each, encoding_name)) for each in texts if each)
 
 
-def count_tokens(text: Union[str, List[str]], model: str) -> int:
+def count_tokens(text: Union[str, List[str]], model: str, mode: str = "exact") -> int:
     """
     Calculate token count for a given text using tiktoken.
     If the model starts with 'argo:', the part after 'argo:' is used
     to determine the encoding via a MODEL_TO_ENCODING mapping.
+    Counts are cached per text, see `TokenCountCache`.
+
+    With `mode` "estimate" the count is approximated by `estimate_tokens`,
+    with "off" it is 0.
     """
+    if mode == "off":
+        return 0
+    if mode == "estimate":
+        return estimate_tokens(text, model)
 
     encoding_name = get_tiktoken_encoding_model(model)
     encoding = tiktoken.get_encoding(encoding_name)
 
     if isinstance(text, list):
-        return sum([len(encoding.encode(each)) for each in text])
+        return _count_cached(encoding, text)
+
+    return _count_cached(encoding, [text])
+
+
+def count_tokens_batch(texts: List[str], model: str) -> int:
+    """
+    Calculate the total token count of a list of texts with tiktoken's batch
+    encoding, which spreads the texts over threads without holding the GIL.
+    Only texts missing from the token count cache are encoded.
+    """
+    encoding = tiktoken.get_encoding(get_tiktoken_encoding_model(model))
+    return _count_cached(encoding, texts, batch=True)
+
+
+def _get_tokenizer_pool() -> ThreadPoolExecutor:
+    global _tokenizer_pool
+    if _tokenizer_pool is None:
+        _tokenizer_pool = ThreadPoolExecutor(
+            max_workers=TOKENIZER_WORKERS, thread_name_prefix="argoproxy-tokenizer"
+        )
+    return _tokenizer_pool
 
-    return len(encoding.encode(text))
+
+def _has_files(path: str) -> bool:
+    return os.path.isdir(path) and bool(os.listdir(path))
+
+
+def configure_tiktoken_cache(cache_dir: str = "") -> Optional[str]:
+    """
+    Points tiktoken at a local directory of encoding files, so they are read
+    from disk instead of downloaded on first use.
+
+    The directory is, in order of precedence: `cache_dir` (the
+    `tiktoken_cache_dir` config option), an already set TIKTOKEN_CACHE_DIR,
+    or the bundle shipped with the package if the build included one.
+
+    Returns:
+        The directory in use, or None if tiktoken keeps its default.
+    """
+    if cache_dir:
+        os.environ["TIKTOKEN_CACHE_DIR"] = os.path.expanduser(cache_dir)
+    elif "TIKTOKEN_CACHE_DIR" not in os.environ and _has_files(BUNDLED_TIKTOKEN_CACHE):
+        os.environ["TIKTOKEN_CACHE_DIR"] = BUNDLED_TIKTOKEN_CACHE
+    return os.environ.get("TIKTOKEN_CACHE_DIR")
+
+
+def bundle_tiktoken_encodings(
+    cache_dir: str, encodings: Tuple[str, ...] = WARMUP_ENCODINGS
+) -> None:
+    """
+    Downloads `encodings` into `cache_dir`, to be copied to machines
+    without internet access and used as their `tiktoken_cache_dir`.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = os.path.abspath(cache_dir)
+    for name in encodings:
+        tiktoken.get_encoding(name)
+        logger.info(f"Cached tiktoken encoding {name} in {cache_dir}")
+
+
+def warm_up_tokenizers(encodings: Tuple[str, ...] = WARMUP_ENCODINGS) -> List[str]:
+    """
+    Loads `encodings` and runs one encode through each, so the BPE files
+    are parsed and the regexes compiled before the first request.
+
+    Returns:
+        The names of the encodings that could not be loaded.
+    """
+    failed = []
+    for name in encodings:
+        try:
+            tiktoken.get_encoding(name).encode("warm up")
+        except Exception as err:
+            logger.warning(f"Failed to load tiktoken encoding {name}: {err}")
+            failed.append(name)
+    return failed
+
+
+async def warm_up_tokenizers_async(
+    encodings: Tuple[str, ...] = WARMUP_ENCODINGS,
+    timeout: float = TOKENIZER_WARMUP_TIMEOUT,
+) -> List[str]:
+    """
+    Runs `warm_up_tokenizers` in the tokenizer thread pool, giving up after
+    `timeout` seconds so an unreachable download cannot block startup.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(_get_tokenizer_pool(), warm_up_tokenizers, encodings),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"tiktoken warm-up did not finish within {timeout}s")
+        return list(encodings)
+
+
+async def count_tokens_async(
+    text: Union[str, List[str]], model: str, mode: str = "exact"
+) -> int:
+    """
+    Awaitable `count_tokens` that keeps large inputs off the event loop.
+
+    Inputs below TOKENIZE_INLINE_THRESHOLD characters, and any input when
+    `mode` is not "exact", are counted inline. Larger ones are encoded in
+    the tokenizer thread pool, lists of texts with tiktoken's batch
+    encoding, so other streams keep flowing meanwhile.
+    """
+    if mode != "exact":
+        return count_tokens(text, model, mode)
+    size = len(text) if isinstance(text, str) else sum(len(each) for each in text)
+    if size < TOKENIZE_INLINE_THRESHOLD:
+        return count_tokens(text, model)
+
+    loop = asyncio.get_running_loop()
+    if isinstance(text, list):
+        return await loop.run_in_executor(
+            _get_tokenizer_pool(), count_tokens_batch, text, model
+        )
+    return await loop.run_in_executor(_get_tokenizer_pool(), count_tokens, text, model)
+
+
+class StreamStopper:
+    """
+    Applies `stop` sequences and `max_tokens` to streamed text incrementally,
+    so the proxy can end a stream itself when the upstream ignores them.
+
+    Text that could be the beginning of a stop sequence is held back until
+    the next chunk disambiguates it. Completion tokens are counted chunk by
+    chunk with the model's tiktoken encoding, when `max_tokens` is set or
+    `count_usage` is requested, so usage needs no second pass at the end.
+    Without `max_tokens`, `usage_mode` "estimate" approximates the count
+    with `estimate_tokens` and "off" skips it.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        stop: Optional[Union[str, List[str]]] = None,
+        max_tokens: Optional[int] = None,
+        count_usage: bool = False,
+        usage_mode: str = "exact",
+    ):
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stops: List[str] = [s for s in stop or [] if s]
+        self.max_tokens = max_tokens
+        encoding_name = get_tiktoken_encoding_model(model)
+        self.encoding = (
+            tiktoken.get_encoding(encoding_name)
+            if max_tokens is not None or (count_usage and usage_mode == "exact")
+            else None
+        )
+        # Encoding name for estimated usage, when the encoder is not needed
+        self._estimate_with = (
+            encoding_name
+            if self.encoding is None and count_usage and usage_mode == "estimate"
+            else None
+        )
+        self._estimated = 0.0
+        self.completion_tokens = 0
+        self.finish_reason: Optional[str] = None
+        self._held = ""
+        self._max_hold = max((len(s) for s in self.stops), default=1) - 1
+
+    def feed(self, text: str) -> str:
+        """
+        Returns the part of `text` that can be sent on now. Once a stop
+        condition hits, `finish_reason` is set and nothing more is returned.
+        """
+        if self.finish_reason:
+            return ""
+        text, self._held = self._held + text, ""
+
+        if self.stops:
+            positions = [i for i in (text.find(s) for s in self.stops) if i >= 0]
+            if positions:
+                text, hit = self._limit(text[: min(positions)])
+                self.finish_reason = "length" if hit else "stop"
+                return text
+            if held := self._partial_stop_length(text):
+                text, self._held = text[:-held], text[-held:]
+
+        text, hit = self._limit(text)
+        if hit:
+            self.finish_reason = "length"
+        return text
+
+    def flush(self) -> str:
+        """Returns the text still held back once the upstream has finished."""
+        held, self._held = self._held, ""
+        if self.finish_reason or not held:
+            return ""
+        text, hit = self._limit(held)
+        if hit:
+            self.finish_reason = "length"
+        return text
+
+    def _partial_stop_length(self, text: str) -> int:
+        """Length of the longest suffix of `text` that starts a stop sequence."""
+        for length in range(min(self._max_hold, len(text)), 0, -1):
+            tail = text[-length:]
+            if any(stop.startswith(tail) for stop in self.stops):
+                return length
+        return 0
+
+    def _limit(self, text: str) -> Tuple[str, bool]:
+        """Truncates `text` to the remaining token budget."""
+        if self._estimate_with is not None and text:
+            # Summed unrounded, so many small chunks do not inflate the count
+            self._estimated += _estimate(text, self._estimate_with)
+            self.completion_tokens = math.ceil(self._estimated)
+        if self.encoding is None or not text:
+            return text, False
+        tokens = self.encoding.encode(text)
+        if self.max_tokens is None:
+            self.completion_tokens += len(tokens)
+            return text, False
+        remaining = self.max_tokens - self.completion_tokens
+        if len(tokens) < remaining:
+            self.completion_tokens += len(tokens)
+            return text, False
+        self.completion_tokens = self.max_tokens
+        return self.encoding.decode(tokens[: max(remaining, 0)]), True
 
 
 def extract_text_content(content: Union[str, list]) -> str:
@@ -201,7 +603,31 @@ def extract_text_content(content: Union[str, list]) -> str:
     return ""
 
 
-def calculate_prompt_tokens(data: dict, model: str) -> int:
+def _prompt_texts(data: dict) -> Union[str, List[str]]:
+    """
+    Collect the texts making up the prompt of a chat, completion, responses
+    or embedding request.
+    """
+    if "messages" in data:
+        return [
+            extract_text_content(msg["content"])
+            for msg in data["messages"]
+            if "content" in msg
+        ]
+    prompt = data.get("prompt", data.get("input", ""))
+    if isinstance(prompt, list):
+        return [
+            (
+                extract_text_content(item.get("content", ""))
+                if isinstance(item, dict)
+                else extract_text_content(item)
+            )
+            for item in prompt
+        ]
+    return prompt
+
+
+def calculate_prompt_tokens(data: dict, model: str, mode: str = "exact") -> int:
     """
     Calculate prompt tokens from either messages or prompt field in the request data.
     Supports both string content and list of content objects in messages.
@@ -209,17 +635,27 @@ def calculate_prompt_tokens(data: dict, model: str) -> int:
     Args:
         data: The request data dictionary
         model: The model name for token counting
+        mode: The usage mode, one of USAGE_MODES
 
     Returns:
         int: Total token count for the prompt/messages
     """
+    return count_tokens(_prompt_texts(data), model, mode)
 
-    if "messages" in data:
-        messages_content = [
-            extract_text_content(msg["content"])
-            for msg in data["messages"]
-            if "content" in msg
-        ]
-        prompt_tokens = count_tokens(messages_content, model)
-        return prompt_tokens
-    return count_tokens(data.get("prompt", ""), model)
+
+async def calculate_prompt_tokens_async(
+    data: dict, model: str, mode: str = "exact"
+) -> int:
+    """
+    Awaitable `calculate_prompt_tokens`; large prompts are tokenized in the
+    tokenizer thread pool instead of on the event loop.
+
+    Args:
+        data: The request data dictionary
+        model: The model name for token counting
+        mode: The usage mode, one of USAGE_MODES
+
+    Returns:
+        int: Total token count for the prompt/messages
+    """
+    return await count_tokens_async(_prompt_texts(data), model, mode)
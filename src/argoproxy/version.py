@@ -0,0 +1,64 @@
+import json
+import os
+import time
+from typing import Optional
+
+from loguru import logger
+
+from .__init__ import __version__
+
+# The latest PyPI version is cached here for VERSION_CACHE_TTL seconds
+VERSION_CACHE_PATH = os.path.expanduser("~/.cache/argoproxy/latest_version.json")
+VERSION_CACHE_TTL = 24 * 3600
+
+
+async def get_latest_pypi_version(max_age: float = VERSION_CACHE_TTL) -> Optional[str]:
+    """
+    Returns the latest version of argo-proxy on PyPI, None if unknown.
+
+    A result fetched less than `max_age` seconds ago is read from
+    `VERSION_CACHE_PATH` instead, `0` always fetches it.
+    """
+    try:
+        with open(VERSION_CACHE_PATH) as f:
+            cached = json.load(f)
+        if time.time() - cached["checked_at"] < max_age:
+            return cached["version"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    latest = await _fetch_latest_pypi_version()
+    if latest:
+        try:
+            os.makedirs(os.path.dirname(VERSION_CACHE_PATH), exist_ok=True)
+            with open(VERSION_CACHE_PATH, "w") as f:
+                json.dump({"version": latest, "checked_at": time.time()}, f)
+        except OSError as err:
+            logger.debug(f"Could not cache the latest version: {err}")
+    return latest
+
+
+async def check_version() -> None:
+    """Logs a warning if a newer version is available on PyPI."""
+    latest = await get_latest_pypi_version()
+    if latest and latest != __version__:
+        logger.warning(
+            f"New version available: {latest} (you have {__version__}). "
+            "Run 'pip install --upgrade argo-proxy' to update."
+        )
+
+
+async def _fetch_latest_pypi_version() -> Optional[str]:
+    # Imported here: `argo-proxy --version` with a fresh cache needs no aiohttp
+    import aiohttp
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                "https://pypi.org/pypi/argo-proxy/json", timeout=5
+            ) as response:
+                response.raise_for_status()
+                data = await response.json()
+                return data["info"]["version"]
+    except Exception:
+        return None
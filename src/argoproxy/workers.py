@@ -0,0 +1,212 @@
+import os
+import random
+import signal
+import socket
+import time
+from typing import Dict, Optional
+
+from aiohttp import web
+from loguru import logger
+
+from .app import background_checks, create_app
+from .config import ArgoConfig
+from .runtime import read_config
+from .server import run_server
+from .utils import configure_tiktoken_cache, warm_up_tokenizers
+
+# Workers exiting sooner than this many seconds after their start are
+# restarted with a delay, so a worker failing at startup does not spin
+MIN_WORKER_LIFETIME = 1.0
+# Up to this fraction of worker_max_requests is randomly added per worker,
+# so workers started together do not all recycle at the same time
+MAX_REQUESTS_JITTER = 0.1
+
+
+def preload(config: ArgoConfig, config_path: Optional[str] = None) -> web.Application:
+    """
+    Creates the app and loads the tiktoken encodings and endpoint modules in
+    the supervisor, so the forked workers share them copy-on-write instead
+    of loading their own.
+    """
+    from .endpoints import (  # noqa: F401
+        chat,
+        completions,
+        embed,
+        extras,
+        responses,
+        streams,
+    )
+
+    app = create_app(config, config_path)
+    app["supervisor"] = os.getpid()  # /admin/reload signals it
+    configure_tiktoken_cache(config.tiktoken_cache_dir)
+    if failed := warm_up_tokenizers():
+        logger.warning(f"tiktoken encodings {', '.join(failed)} were not preloaded")
+    return app
+
+
+def _warn_per_process_state(config: ArgoConfig, workers: int) -> None:
+    """
+    Warns about features whose state lives in each worker. SO_REUSEPORT
+    spreads connections over the workers, so they see only part of it.
+    """
+    if config.stream_replay_ttl > 0:
+        logger.warning(
+            f"stream_replay_ttl is set: a /v1/streams resume reaches the worker "
+            f"holding the stream only about 1 in {workers} times; "
+            "set stream_replay_ttl: 0 to turn resumption off"
+        )
+    if config.stream_coalescing:
+        logger.warning(
+            "stream_coalescing only shares streams between requests that "
+            "reach the same worker"
+        )
+    if config.rate_limit_rpm or config.rate_limit_tpm:
+        logger.warning(
+            f"rate_limit_rpm and rate_limit_tpm apply per worker; a client can "
+            f"get up to {workers} times the configured limits"
+        )
+
+
+def _recycle_after(max_requests: int):
+    """Returns a response hook that stops the worker after `max_requests`."""
+    limit = max_requests + random.randint(0, int(max_requests * MAX_REQUESTS_JITTER))
+    served = 0
+
+    async def count_request(request: web.Request, response: web.StreamResponse):
+        nonlocal served
+        served += 1
+        if served == limit:
+            logger.info(f"Worker {os.getpid()} served {served} requests, recycling")
+            # Handled by run_app as a graceful shutdown
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    return count_request
+
+
+def _run_worker(
+    app: web.Application,
+    config: ArgoConfig,
+    run_checks: bool = False,
+    check_urls: bool = False,
+) -> None:
+    # Drop the supervisor's handlers; run_server installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Ignored until run_server installs its handler, rather than fatal
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    random.seed()
+
+    if run_checks:
+        start_checks, stop_checks = background_checks(check_urls)
+        app.on_startup.append(start_checks)
+        app.on_cleanup.append(stop_checks)
+    if config.worker_max_requests:
+        app.on_response_prepare.append(_recycle_after(config.worker_max_requests))
+
+    address = f"{config.host}:{config.port}"
+    run_server(
+        app,
+        config.server,
+        host=config.host,
+        port=config.port,
+        reuse_port=True,
+        print=lambda _: logger.info(f"Worker {os.getpid()} serving on {address}"),
+    )
+
+
+def run_workers(
+    config: ArgoConfig,
+    workers: int,
+    config_path: Optional[str] = None,
+    check_urls: bool = False,
+) -> None:
+    """
+    Runs `workers` event-loop processes sharing the listen port through
+    SO_REUSEPORT, under a supervisor that restarts workers that exit.
+
+    Workers exit with status 0 when recycled after `worker_max_requests`
+    requests, and are replaced like crashed ones. SIGTERM or SIGINT stops
+    all workers gracefully, then the supervisor. SIGHUP reloads the config
+    of the supervisor, for workers started later, and of every worker.
+    The first worker runs the background checks, see `background_checks`.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("--workers requires SO_REUSEPORT, unavailable here")
+
+    _warn_per_process_state(config, workers)
+    app = preload(config, config_path)
+
+    children: Dict[int, float] = {}  # pid -> start time
+    stopping = False
+
+    def spawn(run_checks: bool = False) -> None:
+        pid = os.fork()
+        if pid == 0:
+            # Own process group: a terminal's Ctrl-C reaches only the
+            # supervisor, which forwards a single SIGTERM to drain
+            os.setpgid(0, 0)
+            status = 0
+            try:
+                _run_worker(app, app["runtime"].config, run_checks, check_urls)
+            except BaseException as err:
+                logger.error(f"Worker {os.getpid()} failed: {err}")
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    def signal_workers(signum: int) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        signal_workers(signal.SIGTERM)
+
+    def reload(signum, frame) -> None:
+        runtime = app["runtime"]
+        try:
+            runtime.config, _ = read_config(runtime.config, config_path)
+        except Exception as err:
+            logger.error(f"Configuration not reloaded: {err}")
+            return
+        signal_workers(signal.SIGHUP)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    spawn(run_checks=True)
+    for _ in range(workers - 1):
+        spawn()
+    logger.info(
+        f"Started {workers} workers on http://{config.host}:{config.port} "
+        f"(supervisor {os.getpid()})"
+    )
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+
+        exit_code = os.waitstatus_to_exitcode(status)
+        if exit_code == 0:
+            logger.info(f"Worker {pid} exited, starting a new one")
+        else:
+            logger.warning(f"Worker {pid} exited with {exit_code}, restarting it")
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+            if stopping:  # the SIGTERM forwarded meanwhile missed a new worker
+                continue
+        spawn()
+
+    logger.info("All workers stopped")